@@ -0,0 +1,63 @@
+"""Benchmark the longest common subsequence on long sequences
+
+Generates a sequence of integers and a copy of it with random edits, and
+prints the time and the peak memory use of the LCS for different numbers
+of edits.
+
+Usage: python benchmarks/lcs.py [length]
+"""
+
+import random
+import sys
+import time
+import tracemalloc
+
+from xmldiff.utils import longest_common_subsequence
+
+
+def edit_sequence(rnd, sequence, edits):
+    sequence = list(sequence)
+    for i in range(edits):
+        change = rnd.randrange(3)
+        position = rnd.randrange(len(sequence))
+        if change == 0:
+            # Delete an item
+            del sequence[position]
+        elif change == 1:
+            # Insert a new item
+            sequence.insert(position, -i - 1)
+        else:
+            # Move an item
+            sequence.insert(rnd.randrange(len(sequence)), sequence.pop(position))
+    return sequence
+
+
+def run(left, right):
+    start = time.perf_counter()
+    lcs = longest_common_subsequence(left, right)
+    seconds = time.perf_counter() - start
+
+    # Tracing the memory slows it down, so that is a separate run
+    tracemalloc.start()
+    longest_common_subsequence(left, right)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return seconds, peak, len(lcs)
+
+
+def benchmark():
+    length = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    rnd = random.Random(42)
+    left = list(range(length))
+
+    for edits in (10, 100, 1000, 2000):
+        right = edit_sequence(rnd, left, edits)
+        seconds, peak, common = run(left, right)
+        print(
+            f"{length} items {edits:5} edits: {seconds:6.2f}s "
+            f"{peak / 1024 / 1024:8.1f} MiB {common} in common"
+        )
+
+
+if __name__ == "__main__":
+    benchmark()
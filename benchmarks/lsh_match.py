@@ -0,0 +1,92 @@
+"""Compare the LSH candidate matching with the exhaustive matching
+
+Generates a text heavy document and a changed copy of it, and prints the
+time and the size of the edit script for different numbers of LSH bands.
+More bands find more candidates, which gives smaller edit scripts, but is
+slower.
+
+Usage: python benchmarks/lsh_match.py [paragraphs]
+"""
+
+import random
+import sys
+import time
+
+from copy import deepcopy
+from lxml import etree
+from xmldiff import main
+
+# A vocabulary of made up words
+_rnd = random.Random(0)
+WORDS = [
+    "".join(
+        _rnd.choice("abcdefghijklmnopqrstuvwxyz") for i in range(_rnd.randint(2, 10))
+    )
+    for j in range(2000)
+]
+
+
+def sentence(rnd):
+    return " ".join(rnd.choice(WORDS) for i in range(rnd.randint(5, 30)))
+
+
+def make_document(rnd, paragraphs):
+    root = etree.Element("document")
+    section = None
+    for i in range(paragraphs):
+        if i % 10 == 0:
+            section = etree.SubElement(root, "section")
+            etree.SubElement(section, "title").text = sentence(rnd)
+        para = etree.SubElement(section, "para")
+        para.text = " ".join(sentence(rnd) for i in range(rnd.randint(1, 5)))
+    return root
+
+
+def change_document(rnd, root, changes):
+    root = deepcopy(root)
+    for i in range(changes):
+        paras = root.findall(".//para")
+        para = rnd.choice(paras)
+        change = rnd.randrange(4)
+        if change == 0:
+            # Change some words
+            words = para.text.split()
+            for j in range(rnd.randint(1, 3)):
+                words[rnd.randrange(len(words))] = rnd.choice(WORDS)
+            para.text = " ".join(words)
+        elif change == 1:
+            # Move a paragraph
+            target = rnd.choice(paras)
+            target.addnext(para)
+        elif change == 2:
+            para.getparent().remove(para)
+        else:
+            new = etree.Element("para")
+            new.text = sentence(rnd)
+            para.addnext(new)
+    return root
+
+
+def run(left, right, options):
+    start = time.perf_counter()
+    actions = main.diff_trees(left, right, diff_options=options)
+    return time.perf_counter() - start, len(actions)
+
+
+def benchmark():
+    paragraphs = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    rnd = random.Random(42)
+    left = make_document(rnd, paragraphs)
+    right = change_document(rnd, left, paragraphs // 10)
+    print(f"{len(list(left.iter()))} nodes")
+
+    for ratio_mode in ("fast", "accurate"):
+        for bands in (None, 4, 8, 16, 32):
+            options = {"ratio_mode": ratio_mode, "lsh_bands": bands}
+            seconds, actions = run(left, right, options)
+            name = "exhaustive" if bands is None else f"{bands} bands"
+            print(f"{ratio_mode:>8} {name:>10}: {seconds:6.2f}s {actions:5} actions")
+
+
+if __name__ == "__main__":
+    benchmark()
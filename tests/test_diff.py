@@ -1,6 +1,7 @@
 import os
 import unittest
 
+from copy import deepcopy
 from lxml import etree
 from xmldiff import utils
 from xmldiff.diff import Differ
@@ -106,6 +107,17 @@ class APITests(unittest.TestCase):
         # diffing.
         self.assertIsNot(list(self.differ.diff()), res2)
 
+    def test_copy_left(self):
+        lefttree = etree.fromstring(self.left)
+        result = list(Differ().diff(lefttree, self.righttree))
+        self.assertEqual(etree.tounicode(lefttree), self.left)
+
+        # Without the copy, the left tree is changed into the right tree
+        differ = Differ(copy_left=False)
+        self.assertEqual(list(differ.diff(lefttree, self.righttree)), result)
+        self.assertIs(differ.left, lefttree)
+        self.assertEqual(etree.tounicode(lefttree), self.right)
+
 
 class NodeRatioTests(unittest.TestCase):
     def test_compare_equal(self):
@@ -407,6 +419,41 @@ class NodeRatioTests(unittest.TestCase):
         self.assertEqual(differ.child_ratio(left, right), 0.5)
         self.assertAlmostEqual(differ.node_ratio(left, right), 0.7677947)
 
+    def test_unique_attrs_are_looked_up(self):
+        class CountingDiffer(Differ):
+            compared = []
+
+            def node_ratio(self, left, right):
+                self.compared.append((left.tag, right.tag))
+                return super().node_ratio(left, right)
+
+        left = """<document>
+    <section xml:id="first"><para>First paragraph</para></section>
+    <section xml:id="second"><para>Second paragraph</para></section>
+    <section xml:id="deleted"><para>Deleted paragraph</para></section>
+</document>
+"""
+        right = """<document>
+    <section xml:id="second"><para>Second paragraph</para></section>
+    <section xml:id="first"><para>First paragraph, changed</para></section>
+    <section xml:id="new"><para>New paragraph</para></section>
+</document>
+"""
+        differ = CountingDiffer()
+        matches = differ.match(etree.fromstring(left), etree.fromstring(right))
+        # Only the paragraphs are compared, the sections are looked up
+        self.assertEqual({tags for tags in differ.compared}, {("para", "para")})
+        lpath = differ.left.getroottree().getpath
+        rpath = differ.right.getroottree().getpath
+        self.assertIn(
+            ("/document/section[1]", "/document/section[2]"),
+            [(lpath(x[0]), rpath(x[1])) for x in matches],
+        )
+        self.assertIn(
+            ("/document/section[2]", "/document/section[1]"),
+            [(lpath(x[0]), rpath(x[1])) for x in matches],
+        )
+
     def test_compare_node_rename(self):
         left = """<document>
   <para>First paragraph</para>
@@ -499,6 +546,16 @@ class NodeRatioTests(unittest.TestCase):
         differ = Differ(ratio_mode="faster")
         self.assertAlmostEqual(differ.leaf_ratio(node1, node3), 0.89552238)
 
+        # Bounded is as accurate as accurate:
+        differ = Differ(ratio_mode="bounded")
+        self.assertAlmostEqual(differ.leaf_ratio(node1, node2), 0.3666667)
+        # But if we only care about good matches, it will give up early,
+        # and return something less than the cutoff.
+        self.assertLess(differ.leaf_ratio(node1, node2, 0.5), 0.5)
+        # The exact ratio is returned for good enough matches.
+        self.assertAlmostEqual(differ.leaf_ratio(node1, node3, 0.3), 0.3880597)
+        self.assertAlmostEqual(differ.leaf_ratio(node1, node3), 0.3880597)
+
         # Invalid modes raise error:
         with self.assertRaises(ValueError):
             differ = Differ(ratio_mode="allezlebleus")
@@ -819,6 +876,47 @@ class MatchTests(unittest.TestCase):
             ],
         )
 
+    def test_bounded_ratio_mode(self):
+        # The bounded ratio mode gives the same result as the accurate one
+        here = os.path.split(__file__)[0]
+        lfile = os.path.join(here, "test_data", "rmldoc.left.xml")
+        rfile = os.path.join(here, "test_data", "rmldoc.right.xml")
+        with open(lfile, "rb") as infile:
+            left = infile.read()
+        with open(rfile, "rb") as infile:
+            right = infile.read()
+
+        results = []
+        for ratio_mode in ("accurate", "bounded"):
+            differ = Differ(ratio_mode=ratio_mode)
+            differ.set_trees(etree.fromstring(left), etree.fromstring(right))
+            matches = differ.match()
+            lpath = differ.left.getroottree().getpath
+            rpath = differ.right.getroottree().getpath
+            results.append([(lpath(x[0]), rpath(x[1]), x[2]) for x in matches])
+        self.assertEqual(results[0], results[1])
+
+    def test_workers(self):
+        # Calculating the ratios in worker processes gives the same result
+        here = os.path.split(__file__)[0]
+        lfile = os.path.join(here, "test_data", "sbt_template.left.xml")
+        rfile = os.path.join(here, "test_data", "sbt_template.right.xml")
+        with open(lfile, "rb") as infile:
+            left = infile.read()
+        with open(rfile, "rb") as infile:
+            right = infile.read()
+
+        for options in ({}, {"best_match": True}, {"tag_match": True}):
+            results = []
+            for workers in (None, 2):
+                differ = Differ(ratio_mode="accurate", workers=workers, **options)
+                differ.set_trees(etree.fromstring(left), etree.fromstring(right))
+                matches = differ.match()
+                lpath = differ.left.getroottree().getpath
+                rpath = differ.right.getroottree().getpath
+                results.append([(lpath(x[0]), rpath(x[1]), x[2]) for x in matches])
+            self.assertEqual(results[0], results[1])
+
 
 class BestFastMatchTests(unittest.TestCase):
     def _match(self, left, right, fast_match=False, best_match=False):
@@ -967,6 +1065,613 @@ class BestFastMatchTests(unittest.TestCase):
         )
 
 
+class HashMatchTests(unittest.TestCase):
+    def _match(self, left, right, differ_class=Differ):
+        parser = etree.XMLParser(remove_blank_text=True)
+        left_tree = etree.fromstring(left, parser)
+        right_tree = etree.fromstring(right, parser)
+        differ = differ_class(hash_match=True)
+        differ.set_trees(left_tree, right_tree)
+        matches = differ.match()
+        lpath = differ.left.getroottree().getpath
+        rpath = differ.right.getroottree().getpath
+        return [(lpath(item[0]), rpath(item[1])) for item in matches]
+
+    def test_same_tree(self):
+        class CountingDiffer(Differ):
+            calls = 0
+
+            def node_ratio(self, left, right):
+                CountingDiffer.calls += 1
+                return super().node_ratio(left, right)
+
+        xml = """<document>
+    <story firstPageTemplate="FirstPage">
+        <section ref="3" single-ref="3">
+            <para>First paragraph</para>
+        </section>
+        <section ref="4" single-ref="4">
+            <para>Last paragraph</para>
+        </section>
+    </story>
+</document>
+"""
+        result = self._match(xml, xml, CountingDiffer)
+        # Everything matches, without comparing any nodes
+        self.assertEqual(len(result), 6)
+        self.assertEqual(CountingDiffer.calls, 0)
+
+    def test_move_children(self):
+        left = """<document>
+    <story firstPageTemplate="FirstPage">
+        <section ref="3" single-ref="3">
+            <para>First paragraph</para>
+            <para>Second paragraph</para>
+            <para>Last paragraph</para>
+        </section>
+    </story>
+</document>
+"""
+
+        right = """<document>
+    <story firstPageTemplate="FirstPage">
+        <section ref="3" single-ref="3">
+            <para>Second paragraph</para>
+            <para>Last paragraph</para>
+            <para>First paragraph</para>
+        </section>
+    </story>
+</document>
+"""
+        result = sorted(self._match(left, right))
+        self.assertEqual(
+            result,
+            [
+                ("/document", "/document"),
+                ("/document/story", "/document/story"),
+                ("/document/story/section", "/document/story/section"),
+                ("/document/story/section/para[1]", "/document/story/section/para[3]"),
+                ("/document/story/section/para[2]", "/document/story/section/para[1]"),
+                ("/document/story/section/para[3]", "/document/story/section/para[2]"),
+            ],
+        )
+
+    def test_changed_subtree(self):
+        left = """<document>
+    <section><para>First paragraph</para><para>Same</para></section>
+    <section><para>Second paragraph</para></section>
+</document>
+"""
+
+        right = """<document>
+    <section><para>Second paragraph</para></section>
+    <section><para>First changed paragraph</para><para>Same</para></section>
+</document>
+"""
+        # The identical section is matched by hash, the changed one
+        # by comparing the nodes.
+        result = sorted(self._match(left, right))
+        self.assertEqual(
+            result,
+            [
+                ("/document", "/document"),
+                ("/document/section[1]", "/document/section[2]"),
+                ("/document/section[1]/para[1]", "/document/section[2]/para[1]"),
+                ("/document/section[1]/para[2]", "/document/section[2]/para[2]"),
+                ("/document/section[2]", "/document/section[1]"),
+                ("/document/section[2]/para", "/document/section[1]/para"),
+            ],
+        )
+
+        # And the diff is still correct
+        parser = etree.XMLParser(remove_blank_text=True)
+        differ = Differ(hash_match=True)
+        differ.set_trees(
+            etree.fromstring(left, parser), etree.fromstring(right, parser)
+        )
+        list(differ.diff())
+        compare_elements(differ.left, differ.right)
+
+
+class TagMatchTests(unittest.TestCase):
+    def _diff(self, left, right, **kw):
+        parser = etree.XMLParser(remove_blank_text=True)
+        differ = Differ(**kw)
+        differ.set_trees(
+            etree.fromstring(left, parser), etree.fromstring(right, parser)
+        )
+        editscript = list(differ.diff())
+        compare_elements(differ.left, differ.right)
+        return editscript
+
+    def test_same_tag_only(self):
+        class CountingDiffer(Differ):
+            calls = 0
+
+            def node_ratio(self, left, right):
+                CountingDiffer.calls += 1
+                return super().node_ratio(left, right)
+
+        left = """<document>
+    <story><para>First paragraph</para><note>A note</note></story>
+    <story><para>Last paragraph</para><note>Another note</note></story>
+</document>
+"""
+        right = """<document>
+    <story><note>Another note</note><para>Last paragraph</para></story>
+    <story><note>A note</note><para>First paragraph</para></story>
+</document>
+"""
+        differ = CountingDiffer()
+        differ.match(etree.fromstring(left), etree.fromstring(right))
+        all_calls = CountingDiffer.calls
+
+        CountingDiffer.calls = 0
+        differ = CountingDiffer(tag_match=True)
+        differ.match(etree.fromstring(left), etree.fromstring(right))
+        self.assertLess(CountingDiffer.calls, all_calls)
+
+        # The result is the same in this case
+        self.assertEqual(
+            self._diff(left, right), self._diff(left, right, tag_match=True)
+        )
+
+    def test_rename(self):
+        left = "<document><para>Some text</para></document>"
+        right = "<document><p>Some text</p></document>"
+
+        # Without tag_match the node is renamed
+        result = self._diff(left, right)
+        self.assertEqual(result, [RenameNode("/document/para[1]", "p")])
+
+        # With tag_match it can't be matched, so it's replaced
+        result = self._diff(left, right, tag_match=True)
+        self.assertEqual(
+            result,
+            [
+                InsertNode("/document[1]", "p", 0),
+                UpdateTextIn("/document/p[1]", "Some text", None),
+                DeleteNode("/document/para[1]"),
+            ],
+        )
+
+        # Unless we fall back to the other tags
+        result = self._diff(left, right, tag_match=True, tag_fallback=True)
+        self.assertEqual(result, [RenameNode("/document/para[1]", "p")])
+
+
+class GumTreeMatchTests(unittest.TestCase):
+    def _diff(self, left, right, **kw):
+        parser = etree.XMLParser(remove_blank_text=True)
+        differ = Differ(**kw)
+        differ.set_trees(
+            etree.fromstring(left, parser), etree.fromstring(right, parser)
+        )
+        editscript = list(differ.diff())
+        compare_elements(differ.left, differ.right)
+        return editscript
+
+    def test_move_subtree(self):
+        left = """<document>
+    <story><para>First paragraph</para><para>Second paragraph</para></story>
+    <story><para>Third paragraph</para></story>
+</document>
+"""
+        right = """<document>
+    <story><para>Third paragraph</para></story>
+    <story><para>First paragraph</para><para>Second paragraph</para></story>
+</document>
+"""
+        result = self._diff(left, right, gumtree_match=True)
+        self.assertEqual(result, [MoveNode("/document/story[1]", "/document[1]", 1)])
+
+    def test_changed_parent(self):
+        # The parent isn't identical, but is matched from its children
+        left = """<document>
+    <story id="1"><para>First paragraph</para><para>Second paragraph</para></story>
+</document>
+"""
+        right = """<document>
+    <story id="2"><para>First paragraph</para><para>Second paragraph</para><para>New</para></story>
+</document>
+"""
+        result = self._diff(left, right, gumtree_match=True)
+        self.assertEqual(
+            result,
+            [
+                UpdateAttrib("/document/story[1]", "id", "2"),
+                InsertNode("/document/story[1]", "para", 2),
+                UpdateTextIn("/document/story/para[3]", "New", None),
+            ],
+        )
+
+    def test_changed_text(self):
+        # Children that aren't identical are matched when the parents are
+        left = """<document>
+    <story><para>First paragraph</para><para>Second paragraph</para></story>
+</document>
+"""
+        right = """<document>
+    <story><para>First paragraph</para><para>Second paragraphs</para></story>
+</document>
+"""
+        result = self._diff(left, right, gumtree_match=True)
+        self.assertEqual(
+            result,
+            [
+                UpdateTextIn(
+                    "/document/story/para[2]", "Second paragraphs", "Second paragraph"
+                )
+            ],
+        )
+
+    def test_changed_leaves(self):
+        # The aligned children are compared first, so when all of them have
+        # changed, each is only compared with its partner
+        rows = 200
+        left = "<document>%s</document>" % "".join(
+            "<row>This is row number %s of the table</row>" % i for i in range(rows)
+        )
+        right = "<document>%s</document>" % "".join(
+            "<row>This is row number %s of the tables</row>" % i for i in range(rows)
+        )
+        parser = etree.XMLParser(remove_blank_text=True)
+        differ = Differ(gumtree_match=True)
+        differ.set_trees(
+            etree.fromstring(left, parser), etree.fromstring(right, parser)
+        )
+        result = list(differ.diff())
+        self.assertEqual(len(result), rows)
+        self.assertTrue(all(isinstance(a, UpdateTextIn) for a in result))
+        self.assertEqual(differ._comparisons, rows)
+
+    def test_moved_changed_children(self):
+        # Only one of the swapped children is aligned with its partner, the
+        # other is found among the children with the same tag
+        left = """<document>
+    <story><para>First paragraph</para><note>A note here</note></story>
+</document>
+"""
+        right = """<document>
+    <story><note>A note there</note><para>First paragraphs</para></story>
+</document>
+"""
+        result = self._diff(left, right, gumtree_match=True)
+        self.assertEqual(
+            [type(action) for action in result],
+            [MoveNode, UpdateTextIn, UpdateTextIn],
+        )
+
+
+class LSHMatchTests(unittest.TestCase):
+    def test_fewer_comparisons(self):
+        class CountingDiffer(Differ):
+            calls = 0
+
+            def leaf_ratio(self, left, right, cutoff=0):
+                CountingDiffer.calls += 1
+                return super().leaf_ratio(left, right, cutoff)
+
+        left = """<document>
+    <para>The quick brown fox jumps over the lazy dog</para>
+    <para>Lorem ipsum dolor sit amet, consectetur adipiscing elit</para>
+    <para>Sphinx of black quartz, judge my vow</para>
+    <para>How vexingly quick daft zebras jump</para>
+</document>
+"""
+        right = """<document>
+    <para>How vexingly quick daft zebras jump!</para>
+    <para>The quick brown fox jumped over the lazy dog</para>
+    <para>Lorem ipsum dolor sit amet, consectetur adipiscing elit</para>
+    <para>Sphinx of black quartz, judge my vows</para>
+</document>
+"""
+        parser = etree.XMLParser(remove_blank_text=True)
+        results = []
+        calls = []
+        for lsh_bands in (None, 16):
+            CountingDiffer.calls = 0
+            differ = CountingDiffer(lsh_bands=lsh_bands)
+            differ.set_trees(
+                etree.fromstring(left, parser), etree.fromstring(right, parser)
+            )
+            results.append(list(differ.diff()))
+            calls.append(CountingDiffer.calls)
+
+        self.assertEqual(results[0], results[1])
+        self.assertLess(calls[1], calls[0])
+
+
+class BudgetTests(unittest.TestCase):
+    left = """<document>
+    <story>
+        <para>Lorem ipsum dolor sit amet</para>
+        <para>Sphinx of black quartz</para>
+        <para>The quick brown fox</para>
+    </story>
+</document>
+"""
+    right = """<document>
+    <story>
+        <para>Lorem ipsum dolor sit amet</para>
+        <para>Sphinx of black quartz</para>
+        <para>The quick brown fox jumps</para>
+    </story>
+</document>
+"""
+
+    def _diff(self, **kw):
+        parser = etree.XMLParser(remove_blank_text=True)
+        differ = Differ(**kw)
+        differ.set_trees(
+            etree.fromstring(self.left, parser), etree.fromstring(self.right, parser)
+        )
+        editscript = list(differ.diff())
+        compare_elements(differ.left, differ.right)
+        return differ, editscript
+
+    def test_within_budget(self):
+        differ, result = self._diff(max_comparisons=1000, timeout=60)
+        self.assertFalse(differ.budget_exceeded)
+        self.assertEqual(
+            result,
+            [
+                UpdateTextIn(
+                    "/document/story/para[3]",
+                    "The quick brown fox jumps",
+                    "The quick brown fox",
+                )
+            ],
+        )
+
+    def test_max_comparisons(self):
+        with self.assertWarns(RuntimeWarning):
+            differ, result = self._diff(max_comparisons=1)
+        self.assertTrue(differ.budget_exceeded)
+        # The changed paragraph is no longer matched, but the others are
+        self.assertEqual(
+            result,
+            [
+                InsertNode("/document/story[1]", "para", 2),
+                UpdateTextIn(
+                    "/document/story/para[3]", "The quick brown fox jumps", None
+                ),
+                DeleteNode("/document/story/para[4]"),
+            ],
+        )
+
+    def test_timeout(self):
+        with self.assertWarns(RuntimeWarning):
+            differ, result = self._diff(timeout=0)
+        self.assertTrue(differ.budget_exceeded)
+        self.assertEqual(len(result), 3)
+
+    def test_fast_match(self):
+        with self.assertWarns(RuntimeWarning):
+            differ, result = self._diff(max_comparisons=0, fast_match=True)
+        self.assertTrue(differ.budget_exceeded)
+        self.assertEqual(len(result), 3)
+
+    def test_max_lcs_cost(self):
+        parser = etree.XMLParser(remove_blank_text=True)
+        left = "<doc>%s</doc>" % "".join(f"<p>Para {i}</p>" for i in range(20))
+        right = "<doc>%s</doc>" % "".join(
+            f"<p>Para {i}</p>" for i in reversed(range(20))
+        )
+
+        differ = Differ(max_lcs_cost=2)
+        differ.set_trees(
+            etree.fromstring(left, parser), etree.fromstring(right, parser)
+        )
+        result = list(differ.diff())
+        compare_elements(differ.left, differ.right)
+        self.assertGreater(differ.lcs_cutoffs, 0)
+        # It is still a correct diff, and never better than without the limit
+        self.assertGreaterEqual(len(result), 19)
+
+        differ = Differ(max_lcs_cost=100)
+        differ.set_trees(
+            etree.fromstring(left, parser), etree.fromstring(right, parser)
+        )
+        self.assertEqual(len(list(differ.diff())), 19)
+        self.assertEqual(differ.lcs_cutoffs, 0)
+
+
+class PathCacheTests(unittest.TestCase):
+    def _check_paths(self, left, right, **kw):
+        test = self
+
+        class CheckingDiffer(Differ):
+            def getpath(self, node):
+                path = super().getpath(node)
+                test.assertEqual(path, utils.getpath(node))
+                return path
+
+        parser = etree.XMLParser(remove_blank_text=True)
+        differ = CheckingDiffer(**kw)
+        differ.set_trees(
+            etree.fromstring(left, parser), etree.fromstring(right, parser)
+        )
+        result = list(differ.diff())
+        compare_elements(differ.left, differ.right)
+        return result
+
+    def test_cached_path(self):
+        differ = Differ()
+        differ.match(
+            etree.fromstring("<doc><a/><b/><a/></doc>"),
+            etree.fromstring("<doc><a/><b/><a/></doc>"),
+        )
+        b = differ.left[1]
+        a = differ.left[2]
+        self.assertEqual(differ.getpath(b), "/doc/b[1]")
+        self.assertEqual(differ.getpath(a), "/doc/a[2]")
+
+        # Removing an a changes the path of the other
+        differ.invalidate_path(differ.left, "a")
+        differ.left.remove(differ.left[0])
+        self.assertEqual(differ.getpath(b), "/doc/b[1]")
+        self.assertEqual(differ.getpath(a), "/doc/a[1]")
+
+    def test_test_data(self):
+        here = os.path.split(__file__)[0]
+        for name in ("all_actions", "namespace", "rmldoc", "sbt_template"):
+            lfile = os.path.join(here, "test_data", name + ".left.xml")
+            rfile = os.path.join(here, "test_data", name + ".right.xml")
+            with open(lfile, "rb") as infile:
+                left = infile.read()
+            with open(rfile, "rb") as infile:
+                right = infile.read()
+            self._check_paths(left, right)
+
+    def test_default_namespace(self):
+        # Elements in a default namespace are counted among all elements,
+        # so moving a para also changes the path of the section.
+        left = """<doc xmlns="urn:d">
+    <section>Text<para/></section>
+    <para/>
+</doc>
+"""
+        right = """<doc xmlns="urn:d">
+    <para/>
+</doc>
+"""
+        result = self._check_paths(left, right)
+        self.assertEqual(
+            result,
+            [
+                MoveNode("/*/*[1]/*[1]", "/*[1]", 0),
+                DeleteNode("/*/*[3]"),
+                DeleteNode("/*/*[2]"),
+            ],
+        )
+
+
+class CleanSubtreeTests(unittest.TestCase):
+    def test_skip_identical_subtrees(self):
+        left = """<document>
+    <story>
+        <section><para>First</para><para>Second</para></section>
+        <section><para>Third</para><para>Fourth</para></section>
+    </story>
+</document>
+"""
+        right = """<document>
+    <story>
+        <section><para>First</para><para>Second</para></section>
+        <section><para>Third</para><para>Fourth, changed</para></section>
+    </story>
+</document>
+"""
+        paths = []
+
+        class PathDiffer(Differ):
+            def getpath(self, node):
+                path = super().getpath(node)
+                paths.append(path)
+                return path
+
+        parser = etree.XMLParser(remove_blank_text=True)
+        differ = PathDiffer()
+        differ.set_trees(
+            etree.fromstring(left, parser), etree.fromstring(right, parser)
+        )
+        result = list(differ.diff())
+        self.assertEqual(
+            result,
+            [
+                UpdateTextIn(
+                    "/document/story/section[2]/para[2]", "Fourth, changed", "Fourth"
+                )
+            ],
+        )
+        # The identical subtrees are skipped entirely
+        self.assertNotIn("/document/story/section[1]", paths)
+        self.assertNotIn("/document/story/section[1]/para[1]", paths)
+        self.assertNotIn("/document/story/section[2]/para[1]", paths)
+        self.assertIn("/document/story/section[2]/para[2]", paths)
+
+        # The second section and its parents are not identical
+        clean = differ.clean_subtrees()
+        rsnap = differ._rsnap
+        self.assertEqual(
+            [rsnap.nodes[i].text for i in range(len(rsnap)) if clean[i]],
+            ["First", "Second", None, "Third"],
+        )
+
+
+class ChangeDetectionTests(unittest.TestCase):
+    def test_identical(self):
+        left = etree.fromstring("<doc><p>Text</p><!-- Comment --></doc>")
+        differ = Differ()
+        self.assertTrue(differ.identical(left, deepcopy(left)))
+
+        # The snapshots are reused by the match
+        lsnap = differ._lsnap
+        self.assertEqual(list(differ.diff()), [])
+        self.assertIs(differ._lsnap, lsnap)
+
+        right = etree.fromstring("<doc><p>Text</p><!-- Changed --></doc>")
+        self.assertFalse(differ.identical(left, right))
+        right = deepcopy(left)
+        right.tail = "Tail"
+        self.assertFalse(differ.identical(left, right))
+        # The namespaces are not a part of the hashes
+        right = etree.fromstring(
+            '<doc xmlns:x="urn:x"><p>Text</p><!-- Comment --></doc>'
+        )
+        self.assertFalse(differ.identical(left, right))
+
+        # Ignored attributes are ignored
+        left = etree.fromstring('<doc><p class="a">Text</p></doc>')
+        right = etree.fromstring('<doc><p class="b">Text</p></doc>')
+        self.assertFalse(Differ().identical(left, right))
+        self.assertTrue(Differ(ignored_attrs=["class"]).identical(left, right))
+
+    def test_count_actions(self):
+        left = etree.fromstring(
+            "<doc><p>First</p><p>Second</p><!-- Comment --><b>Third</b></doc>"
+        )
+        right = etree.fromstring(
+            '<doc><p x="1">First</p><div>Second</div><i>New</i><b>Third</b></doc>'
+        )
+
+        paths = []
+
+        class PathDiffer(Differ):
+            def getpath(self, node):
+                paths.append(node)
+                return super().getpath(node)
+
+        differ = PathDiffer()
+        stats = differ.count_actions(left, right)
+        self.assertEqual(
+            stats,
+            {
+                "actions": {
+                    "InsertAttrib": 1,
+                    "RenameNode": 1,
+                    "InsertNode": 1,
+                    "UpdateTextIn": 1,
+                    "DeleteNode": 1,
+                },
+                "tags": {"p": 2, "i": 2, "#comment": 1},
+            },
+        )
+        # No xpaths were needed
+        self.assertEqual(paths, [])
+
+        # And it's the same actions as in the edit script
+        result = list(Differ().diff(left, right))
+        self.assertEqual(
+            [action.__class__.__name__ for action in result],
+            ["InsertAttrib", "RenameNode", "InsertNode", "UpdateTextIn", "DeleteNode"],
+        )
+        self.assertEqual(
+            Differ().count_actions(left, deepcopy(left)), {"actions": {}, "tags": {}}
+        )
+
+
 class UpdateNodeTests(unittest.TestCase):
     """Testing only the update phase of the diffing"""
 
@@ -977,9 +1682,9 @@ class UpdateNodeTests(unittest.TestCase):
         differ.set_trees(left_tree, right_tree)
         matches = differ.match()
         steps = []
-        for left, right, m in matches:
-            steps.extend(differ.update_node_attr(left, right))
-            steps.extend(differ.update_node_text(left, right))
+        for lnode, rnode, m in matches:
+            steps.extend(differ.update_node_attr(lnode, rnode))
+            steps.extend(differ.update_node_text(lnode, rnode))
 
         return steps
 
@@ -1035,8 +1740,8 @@ class AlignChildrenTests(unittest.TestCase):
         differ.set_trees(left_tree, right_tree)
         matches = differ.match()
         steps = []
-        for left, right, m in matches:
-            steps.extend(differ.align_children(left, right))
+        for lnode, rnode, m in matches:
+            steps.extend(differ.align_children(lnode, rnode))
         return steps
 
     def test_same_tree(self):
@@ -1509,6 +2214,25 @@ class DiffTests(unittest.TestCase):
         result = self._diff(left, right)
         self.assertEqual(result, [InsertComment("/doc[1]", 0, " New comment! ")])
 
+    def test_deep_tree(self):
+        # Deeper than the recursion limit, which the parser won't allow
+        # without huge_tree, so we build it by hand.
+        trees = []
+        for text in ("Old text", "New text"):
+            root = node = etree.Element("a")
+            for i in range(1200):
+                node = etree.SubElement(node, "a")
+            node.text = text
+            trees.append(root)
+        left, right = trees
+
+        differ = Differ()
+        result = list(differ.diff(left, right))
+        self.assertEqual(etree.tostring(differ.left), etree.tostring(right))
+        self.assertEqual(len(result), 1)
+        self.assertEqual(result[0].text, "New text")
+        self.assertEqual(result[0].node.count("/"), 1201)
+
     def test_issue_21_default_namespaces(self):
         # When you have a default namespace you get "*" instead of the
         # expected "tag" in the XPath. This is how libxml does it,
@@ -1,3 +1,4 @@
+import io
 import os
 import sys
 import unittest
@@ -190,6 +191,58 @@ class XMLFormatTests(unittest.TestCase):
         result = formatter.format([action], etree.fromstring(left))
         self.assertEqual(result, expected)
 
+    def test_write(self):
+        left = '<document><node a="v"/><node>Text</node></document>'
+        diff = [actions.DeleteAttrib("/document/node[1]", "a")]
+        for pretty_print in (False, True):
+            formatter = formatting.XMLFormatter(pretty_print=pretty_print)
+            expected = formatter.format(diff, etree.fromstring(left))
+
+            # The result is written to text streams
+            output = io.StringIO()
+            self.assertEqual(formatter.write(diff, etree.fromstring(left), output), 1)
+            self.assertEqual(output.getvalue(), expected)
+
+            # And as UTF-8 to binary streams
+            output = io.BytesIO()
+            self.assertEqual(
+                formatter.write(diff, etree.parse(io.StringIO(left)), output), 1
+            )
+            self.assertEqual(output.getvalue().decode("utf-8"), expected)
+
+    def test_write_chunks(self):
+        # Big documents are written in chunks, and characters that are
+        # split between chunks are decoded
+        root = etree.Element("document")
+        for i in range(5000):
+            etree.SubElement(root, "node").text = "Ünïcödé %s" % i
+        diff = [actions.UpdateTextIn("/document/node[1]", "Änother")]
+        formatter = formatting.XMLFormatter(pretty_print=False)
+        expected = formatter.format(diff, root)
+
+        class Output(io.StringIO):
+            chunks = 0
+
+            def write(self, text):
+                self.chunks += 1
+                return super().write(text)
+
+        output = Output()
+        formatter.write(diff, root, output)
+        self.assertEqual(output.getvalue(), expected)
+        self.assertGreater(output.chunks, 10)
+
+    def test_write_render(self):
+        # Subclasses that render the result differently are still used
+        class Formatter(formatting.XMLFormatter):
+            def render(self, result):
+                return "Rendered"
+
+        left = "<document><node>Text</node></document>"
+        output = io.StringIO()
+        Formatter().write([], etree.fromstring(left), output)
+        self.assertEqual(output.getvalue(), "Rendered")
+
     def test_incorrect_xpaths(self):
         left = '<document><node a="v"/><node>Text</node></document>'
         expected = START + ' diff:delete-attr="a">Text' + END
@@ -455,6 +508,30 @@ class DiffFormatTests(unittest.TestCase):
         expected = '[insert-comment, /document/node, 2, "Commentary"]'
         self._format_test(action, expected)
 
+    def test_write(self):
+        diff = [
+            actions.DeleteNode("/document/node"),
+            actions.RenameNode("/document/node", "nod"),
+        ]
+        formatter = formatting.DiffFormatter()
+
+        # The actions are written as they are generated
+        output = io.StringIO()
+        written = []
+
+        def generate():
+            for action in diff:
+                yield action
+                written.append(output.getvalue())
+
+        self.assertEqual(formatter.write(generate(), None, output), 2)
+        self.assertEqual(output.getvalue(), formatter.format(diff, None))
+        self.assertEqual(written[0], "[delete, /document/node]")
+
+        output = io.StringIO()
+        self.assertEqual(formatter.write([], None, output), 0)
+        self.assertEqual(output.getvalue(), "")
+
 
 class XmlDiffFormatTests(unittest.TestCase):
     # RenameAttr and MoveNode requires an orig_tree, so they
@@ -561,6 +638,13 @@ class XmlDiffFormatTests(unittest.TestCase):
         )
         self.assertEqual(result, expected)
 
+        # Writing gives the same output, and the number of actions, where
+        # the renamed attribute is one action, but two lines
+        output = io.StringIO()
+        result = main.diff_files(lfile, rfile, formatter=formatter, output=output)
+        self.assertEqual(output.getvalue(), expected)
+        self.assertEqual(result, 14)
+
 
 class FormatterFileTests(unittest.TestCase):
     formatter = None  # Override this
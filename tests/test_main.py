@@ -1,10 +1,14 @@
+import contextlib
 import io
+import mmap
 import os
 import sys
+import tempfile
+import threading
 import unittest
 
 from lxml import etree
-from xmldiff import main, formatting
+from xmldiff import actions, main, formatting
 
 CURDIR = os.path.split(__file__)[0]
 LEFT_FILE = os.path.join(CURDIR, "test_data", "rmldoc.left.xml")
@@ -68,6 +72,209 @@ class MainAPITests(unittest.TestCase):
         # This formatter will insert a diff namespace:
         self.assertIn('xmlns:diff="http://namespaces.shoobx.com/diff"', result)
 
+    def test_api_diff_output(self):
+        # The diff can be written to a stream, as it's made
+        formatter = formatting.DiffFormatter()
+        result = main.diff_files(LEFT_FILE, RIGHT_FILE, formatter=formatter)
+        output = io.StringIO()
+        count = main.diff_files(
+            LEFT_FILE, RIGHT_FILE, formatter=formatter, output=output
+        )
+        self.assertEqual(output.getvalue(), result)
+        self.assertEqual(count, len(result.splitlines()))
+
+        # Also with the first difference only
+        output = io.StringIO()
+        left = etree.parse(LEFT_FILE)
+        right = etree.parse(RIGHT_FILE)
+        self.assertEqual(
+            main.diff_trees(
+                left, right, formatter=formatter, mode="first", output=output
+            ),
+            1,
+        )
+        self.assertEqual(
+            output.getvalue(),
+            main.diff_trees(left, right, formatter=formatter, mode="first"),
+        )
+
+        # The XMLFormatter marks up a copy of the left tree as it was
+        formatter = formatting.XMLFormatter(normalize=formatting.WS_BOTH)
+        result = main.diff_files(LEFT_FILE, RIGHT_FILE, formatter=formatter)
+        output = io.StringIO()
+        main.diff_files(LEFT_FILE, RIGHT_FILE, formatter=formatter, output=output)
+        self.assertEqual(output.getvalue(), result)
+
+        # Also when it formats the whole diff before writing it
+        class Formatter(formatting.XMLFormatter):
+            write = formatting.BaseFormatter.write
+
+        output = io.StringIO()
+        count = main.diff_files(
+            LEFT_FILE, RIGHT_FILE, formatter=Formatter(), output=output
+        )
+        self.assertEqual(
+            output.getvalue(),
+            main.diff_files(LEFT_FILE, RIGHT_FILE, formatter=Formatter()),
+        )
+        self.assertGreater(count, 0)
+
+        # Writing needs a formatter
+        with self.assertRaises(ValueError):
+            main.diff_files(LEFT_FILE, RIGHT_FILE, output=output)
+
+    def test_api_custom_formatter(self):
+        # A formatter that reads the original tree while it goes through the
+        # diff gets the tree as it was, unless it says it doesn't need it
+        class Formatter(formatting.BaseFormatter):
+            normalize = formatting.WS_TAGS
+
+            def format(self, diff, orig_tree):
+                updates = [a for a in diff if isinstance(a, actions.UpdateTextIn)]
+                return [
+                    etree.tounicode(orig_tree.xpath(action.node)[0])
+                    for action in updates
+                ]
+
+        left = "<document><a>One</a><b>Two</b></document>"
+        right = "<document><a>Uno</a><b>Two</b></document>"
+        self.assertEqual(
+            main.diff_texts(left, right, formatter=Formatter()), ["<a>One</a>"]
+        )
+
+        self.assertFalse(formatting.DiffFormatter.uses_orig_tree)
+        self.assertFalse(formatting.XMLFormatter.uses_orig_tree)
+        self.assertTrue(formatting.XmlDiffFormatter.uses_orig_tree)
+
+    def test_api_diff_modes(self):
+        left = etree.parse(LEFT_FILE)
+        right = etree.parse(RIGHT_FILE)
+        result = main.diff_trees(left, right)
+
+        # The first difference is the first action of the full diff
+        first = main.diff_trees(left, right, mode="first")
+        self.assertEqual(first, result[:1])
+
+        # And the stats count the actions
+        stats = main.diff_trees(left, right, mode="stats")
+        self.assertEqual(sum(stats["actions"].values()), len(result))
+        self.assertEqual(sum(stats["tags"].values()), len(result))
+        self.assertEqual(
+            stats["actions"]["InsertNode"],
+            len([a for a in result if a.__class__.__name__ == "InsertNode"]),
+        )
+
+        # Identical trees are not diffed at all
+        self.assertEqual(main.diff_trees(left, left, mode="first"), [])
+        self.assertEqual(
+            main.diff_files(LEFT_FILE, LEFT_FILE, mode="stats"),
+            {"actions": {}, "tags": {}},
+        )
+
+        with self.assertRaises(ValueError):
+            main.diff_trees(left, right, mode="fast")
+
+    def test_api_diff_parallel(self):
+        # Parsing the files at the same time gives the same result
+        result = main.diff_files(LEFT_FILE, RIGHT_FILE)
+        self.assertEqual(main.diff_files(LEFT_FILE, RIGHT_FILE, parallel=True), result)
+
+        with open(LEFT_FILE, "rb") as linfile:
+            with open(RIGHT_FILE, "rb") as rinfile:
+                left = linfile.read()
+                right = rinfile.read()
+        self.assertEqual(main.diff_texts(left, right, parallel=True), result)
+
+        # Also when the formatter copies nodes between the trees
+        formatter = formatting.XMLFormatter()
+        self.assertEqual(
+            main.diff_texts(left, right, formatter=formatter, parallel=True),
+            main.diff_texts(left, right, formatter=formatter),
+        )
+
+        # Parse errors are raised as usual
+        with self.assertRaises(etree.XMLSyntaxError):
+            main.diff_texts(left, b"<doc>", parallel=True)
+
+    def test_api_diff_memory_map(self):
+        # Files can be parsed from memory maps, with the same result
+        result = main.diff_files(LEFT_FILE, RIGHT_FILE)
+        self.assertEqual(
+            main.diff_files(LEFT_FILE, RIGHT_FILE, memory_map=True), result
+        )
+        formatter = formatting.XMLFormatter()
+        self.assertEqual(
+            main.diff_files(
+                LEFT_FILE, RIGHT_FILE, formatter=formatter, memory_map=True
+            ),
+            main.diff_files(LEFT_FILE, RIGHT_FILE, formatter=formatter),
+        )
+
+        # Streams are parsed as usual
+        with open(LEFT_FILE, "rb") as linfile:
+            with open(RIGHT_FILE, "rb") as rinfile:
+                self.assertEqual(
+                    main.diff_files(linfile, rinfile, memory_map=True), result
+                )
+
+                # And diff_texts takes the maps
+                with mmap.mmap(linfile.fileno(), 0, access=mmap.ACCESS_READ) as lmap:
+                    with mmap.mmap(
+                        rinfile.fileno(), 0, access=mmap.ACCESS_READ
+                    ) as rmap:
+                        self.assertEqual(main.diff_texts(lmap, rmap), result)
+
+        # An empty file can't be mapped, so it fails as usual
+        with tempfile.NamedTemporaryFile(suffix=".xml") as empty:
+            with self.assertRaises(etree.XMLSyntaxError):
+                main.diff_files(LEFT_FILE, empty.name, memory_map=True)
+
+    def test_api_parser_reuse(self):
+        # Each thread reuses one parser for each set of options
+        parser = main._get_parser(True, False)
+        self.assertIs(main._get_parser(True, False), parser)
+        self.assertIsNot(main._get_parser(False, False), parser)
+        self.assertIsNot(main._get_parser(True, True), parser)
+        thread = threading.Thread(
+            target=lambda: self.assertIsNot(main._get_parser(True, False), parser)
+        )
+        thread.start()
+        thread.join()
+
+    def test_api_huge_tree(self):
+        # Texts over 10 MB stop the parsing, unless it's a huge tree
+        left = b"<doc><text>Short</text></doc>"
+        right = b"<doc><text>" + b"x" * 11_000_000 + b"</text></doc>"
+        with self.assertRaises(etree.XMLSyntaxError):
+            main.diff_texts(left, right)
+        result = main.diff_texts(left, right, huge_tree=True)
+        self.assertIn(11_000_000, [len(getattr(a, "text", None) or "") for a in result])
+
+        left = b'<doc><text id="1">Short</text></doc>'
+        right = b'<doc><text id="1">' + b"x" * 11_000_000 + b"</text></doc>"
+        with self.assertRaises(etree.XMLSyntaxError):
+            list(main.diff_records(io.BytesIO(left), io.BytesIO(right), "text", "id"))
+        result = main.diff_records(
+            io.BytesIO(left), io.BytesIO(right), "text", "id", huge_tree=True
+        )
+        self.assertIn(11_000_000, [len(getattr(a, "text", None) or "") for a in result])
+
+    def test_api_diff_records(self):
+        left = '<export><record id="1">One</record><record id="2">Two</record></export>'
+        right = (
+            '<export><record id="2">Deux</record><record id="1">One</record></export>'
+        )
+        result = main.diff_records(
+            io.BytesIO(left.encode()), io.BytesIO(right.encode()), "record", "id"
+        )
+        # It's a generator
+        self.assertEqual(
+            next(result), actions.MoveNode("/export/record[2]", "/export[1]", 0)
+        )
+        self.assertEqual(
+            list(result), [actions.UpdateTextIn("/export/record[1]", "Deux", "Two")]
+        )
+
 
 class MainCLITests(unittest.TestCase):
     def call_run(self, args, command=main.diff_command):
@@ -166,6 +373,105 @@ class MainCLITests(unittest.TestCase):
         output, errors = self.call_run([file1, file2, "--unique-attributes"])
         self.assertEqual(len(output.splitlines()), 6)
 
+        # The diff can be written to a file
+        with tempfile.TemporaryDirectory() as tmpdir:
+            outfile = os.path.join(tmpdir, "diff.txt")
+            output2, errors = self.call_run([file1, file2, "--output", outfile])
+            self.assertEqual(output2, "")
+            with open(outfile, encoding="utf-8") as f:
+                self.assertEqual(f.read(), output)
+
+            output2, errors = self.call_run(
+                [file1, file2, "-o", outfile, "--formatter", "xml"]
+            )
+            with open(outfile, encoding="utf-8") as f:
+                self.assertEqual(f.read()[0], "<")
+
+        # The files can be parsed at the same time
+        output2, errors = self.call_run([file1, file2, "--parallel-parse"])
+        self.assertEqual(output, output2)
+
+    def test_diff_cli_xml_formatter(self):
+        # The XML formatter marks up the left tree as it was before the diff
+        formatter = formatting.XMLFormatter(
+            normalize=formatting.WS_BOTH, pretty_print=False
+        )
+        expected = main.diff_files(LEFT_FILE, RIGHT_FILE, formatter=formatter)
+
+        output, errors = self.call_run([LEFT_FILE, RIGHT_FILE, "-f", "xml"])
+        self.assertEqual(output, expected + "\n")
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            outfile = os.path.join(tmpdir, "diff.xml")
+            output, errors = self.call_run(
+                [LEFT_FILE, RIGHT_FILE, "-f", "xml", "--output", outfile]
+            )
+            self.assertEqual(output, "")
+            with open(outfile, encoding="utf-8") as f:
+                self.assertEqual(f.read(), expected + "\n")
+
+    def test_diff_cli_modes(self):
+        curdir = os.path.dirname(__file__)
+        filepath = os.path.join(curdir, "test_data")
+        file1 = os.path.join(filepath, "example.left.html")
+        file2 = os.path.join(filepath, "example.right.html")
+
+        # Only the first of the six actions
+        output, errors = self.call_run([file1, file2, "--first"])
+        self.assertEqual(len(output.splitlines()), 1)
+
+        output, errors = self.call_run([file1, file2, "--stats"])
+        lines = output.splitlines()
+        self.assertEqual(lines[0], "Actions:")
+        self.assertIn("Tags:", lines)
+        counts = [int(line.split(": ")[1]) for line in lines if line[0] == " "]
+        self.assertEqual(sum(counts), 12)
+
+        # Both can be used with --check, like all formatters
+        with contextlib.redirect_stdout(io.StringIO()):
+            for formatter in ("diff", "xml", "old"):
+                args = [file1, file2, "--formatter", formatter, "--check"]
+                self.assertEqual(main.diff_command(args), 1)
+                args = [file1, file1, "--formatter", formatter, "--check"]
+                self.assertIsNone(main.diff_command(args))
+            for mode in ("--first", "--stats"):
+                self.assertEqual(main.diff_command([file1, file2, mode, "--check"]), 1)
+                self.assertIsNone(main.diff_command([file1, file1, mode, "--check"]))
+
+        # But not with each other
+        with self.assertRaises(SystemExit):
+            self.call_run([file1, file2, "--first", "--stats"])
+
+    def test_diff_cli_records(self):
+        curdir = os.path.dirname(__file__)
+        filepath = os.path.join(curdir, "test_data")
+        file1 = os.path.join(filepath, "records_1.xml")
+        file2 = os.path.join(filepath, "records_2.xml")
+
+        args = [file1, file2, "--record-tag", "record", "--record-key", "id"]
+        output, errors = self.call_run(args)
+        self.assertEqual(
+            output.splitlines(),
+            [
+                "[move, /export/record[3], /export[1], 0]",
+                "[insert, /export[1], record, 2]",
+                '[insert-attribute, /export/record[3], id, "4"]',
+                "[insert, /export/record[3], name, 0]",
+                '[update-text, /export/record[3]/name[1], "Fourth", null]',
+                "[delete, /export/record[4]]",
+            ],
+        )
+
+        output, errors = self.call_run(args + ["--first"])
+        self.assertEqual(len(output.splitlines()), 1)
+
+        # The records can only be formatted as actions
+        with self.assertRaises(SystemExit):
+            self.call_run(args + ["--formatter", "xml"])
+        # And both the tag and the key are needed
+        with self.assertRaises(SystemExit):
+            self.call_run(args[:4])
+
     def test_patch_cli_simple(self):
         curdir = os.path.dirname(__file__)
         filepath = os.path.join(curdir, "test_data")
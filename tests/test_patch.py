@@ -4,7 +4,7 @@ import unittest
 from lxml import etree
 from xmldiff.formatting import DiffFormatter, WS_NONE
 from xmldiff.main import diff_trees, diff_texts, patch_text, patch_file
-from xmldiff.patch import Patcher, DiffParser
+from xmldiff.patch import Patcher, DiffParser, NodeIdResolver
 from xmldiff.actions import (
     UpdateTextIn,
     InsertNode,
@@ -120,6 +120,19 @@ class DiffPatch(unittest.TestCase):
         # top level comment differs, but that's OK.
         compare_elements(result, right.getroot())
 
+    def test_patch_without_copy(self):
+        left = etree.fromstring("<document><p>Text</p></document>")
+        right = etree.fromstring("<document><p>Text</p><p>More</p></document>")
+        diff = diff_trees(left, right)
+
+        result = Patcher().patch(diff, left)
+        self.assertIsNot(result, left)
+        compare_elements(result, right)
+
+        result = Patcher().patch(diff, left, copy=False)
+        self.assertIs(result, left)
+        compare_elements(left, right)
+
     def test_diff_default_namespace(self):
         here = os.path.split(__file__)[0]
         lfile = os.path.join(here, "test_data", "namespace.left.xml")
@@ -136,6 +149,70 @@ class DiffPatch(unittest.TestCase):
         compare_elements(result, right.getroot())
 
 
+class NodeIdTests(unittest.TestCase):
+    left = """<document>
+    <story>
+        <para>The quick brown fox</para>
+    </story>
+</document>
+"""
+    right = """<document>
+    <story>
+        <para>The quick brown fox</para>
+        <note class="new">Sphinx of black quartz</note>
+    </story>
+</document>
+"""
+
+    def _trees(self):
+        parser = etree.XMLParser(remove_blank_text=True)
+        return etree.fromstring(self.left, parser), etree.fromstring(self.right, parser)
+
+    def test_node_ids(self):
+        left, right = self._trees()
+        diff = diff_trees(left, right, diff_options={"node_ids": True})
+        # The nodes are numbered in post order, the inserted note is 3
+        self.assertEqual(
+            diff,
+            [
+                InsertNode(1, "note", 1),
+                InsertAttrib(3, "class", "new"),
+                UpdateTextIn(3, "Sphinx of black quartz"),
+            ],
+        )
+        result = Patcher().patch(diff, left)
+        compare_elements(result, right)
+
+    def test_resolve(self):
+        left, right = self._trees()
+        diff = diff_trees(left, right, diff_options={"node_ids": True})
+        self.assertEqual(
+            list(NodeIdResolver().resolve(diff, left)), diff_trees(left, right)
+        )
+
+    def test_formatter(self):
+        left, right = self._trees()
+        formatter = DiffFormatter(normalize=WS_NONE)
+        self.assertEqual(
+            diff_trees(left, right, {"node_ids": True}, formatter),
+            diff_trees(left, right, formatter=formatter),
+        )
+
+    def test_diff_patch(self):
+        here = os.path.split(__file__)[0]
+        for name in ("all_actions", "namespace"):
+            lfile = os.path.join(here, "test_data", name + ".left.xml")
+            rfile = os.path.join(here, "test_data", name + ".right.xml")
+            left = etree.parse(lfile)
+            right = etree.parse(rfile)
+            diff = diff_trees(left, right, diff_options={"node_ids": True})
+            result = Patcher().patch(diff, left)
+            compare_elements(result, right.getroot())
+            self.assertEqual(
+                list(NodeIdResolver().resolve(diff, left)), diff_trees(left, right)
+            )
+
+
 TEST_DIFF = """[delete, node]
 [insert, target, tag, 0]
 [rename, node, tag]
@@ -0,0 +1,73 @@
+import pickle
+import unittest
+
+from lxml import etree
+from xmldiff.diff import Differ
+from xmldiff.snapshot import TreeSnapshot
+
+
+class TreeSnapshotTests(unittest.TestCase):
+    def test_snapshot(self):
+        xml = """<document>
+    <story>
+        <para>First paragraph</para>
+        <para>Last paragraph</para>
+    </story>
+    <!-- A comment -->
+</document>
+"""
+        parser = etree.XMLParser(remove_blank_text=True)
+        root = etree.fromstring(xml, parser)
+        differ = Differ()
+        snap = differ.snapshot(root)
+
+        # The nodes are in post order
+        self.assertEqual(len(snap), 5)
+        self.assertIs(snap.nodes[-1], root)
+        self.assertEqual(
+            [node.tag for node in snap.nodes[:3]], ["para", "para", "story"]
+        )
+        self.assertEqual(snap.index[id(root)], 4)
+
+        self.assertEqual(list(snap.parents), [2, 2, 4, 4, -1])
+        self.assertEqual(list(snap.get_children(2)), [0, 1])
+        self.assertEqual(list(snap.get_children(4)), [2, 3])
+        self.assertEqual(list(snap.get_children(0)), [])
+        self.assertEqual(list(snap.subtree(2)), [0, 1, 2])
+        self.assertEqual(list(snap.sizes), [1, 1, 3, 1, 5])
+        self.assertEqual(list(snap.heights), [1, 1, 2, 1, 3])
+
+        # The two paras have the same tag, but not the same hash
+        self.assertEqual(snap.tags[0], snap.tags[1])
+        self.assertNotEqual(snap.hashes[0], snap.hashes[1])
+
+        self.assertEqual(snap.texts[0], "para First paragraph")
+        self.assertEqual(snap.texts[3], " A comment ")
+        self.assertEqual(snap.text_lengths[0], 20)
+
+    def test_comparable_hashes(self):
+        left = etree.fromstring("<doc><a>Text</a><b>More</b></doc>")
+        right = etree.fromstring("<doc><b>More</b><c/><a>Text</a></doc>")
+        tag_ids = {}
+        hash_keys = {}
+        differ = Differ()
+        lsnap = differ.snapshot(left, tag_ids, hash_keys)
+        rsnap = differ.snapshot(right, tag_ids, hash_keys)
+
+        self.assertEqual(lsnap.hashes[0], rsnap.hashes[2])
+        self.assertEqual(lsnap.hashes[1], rsnap.hashes[0])
+        self.assertNotIn(rsnap.hashes[1], lsnap.hashes)
+        self.assertNotEqual(lsnap.hashes[2], rsnap.hashes[3])
+        self.assertEqual(lsnap.tags[2], rsnap.tags[3])
+
+    def test_pickle(self):
+        root = etree.fromstring("<doc><a>Text</a><b>More</b></doc>")
+        snap = TreeSnapshot(root, Differ().node_text, dict)
+        copy = pickle.loads(pickle.dumps(snap))
+
+        # The nodes are not pickled, but everything else is
+        self.assertFalse(hasattr(copy, "nodes"))
+        self.assertEqual(len(copy), 3)
+        self.assertEqual(copy.texts, snap.texts)
+        self.assertEqual(copy.hashes, snap.hashes)
+        self.assertEqual(list(copy.get_children(2)), [0, 1])
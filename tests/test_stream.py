@@ -0,0 +1,143 @@
+import io
+import unittest
+
+from lxml import etree
+from xmldiff import actions, patch
+from xmldiff.stream import RecordDiffer
+
+
+def make_doc(records, root="export"):
+    return "<%s>%s</%s>" % (root, "".join(records), root)
+
+
+class RecordDifferTests(unittest.TestCase):
+    def _diff(self, left, right, **kw):
+        differ = RecordDiffer("record", "id", **kw)
+        result = list(
+            differ.diff(io.BytesIO(left.encode()), io.BytesIO(right.encode()))
+        )
+        # The actions turn the whole left document into the right one
+        patched = patch.Patcher().patch(result, etree.fromstring(left))
+        self.assertEqual(etree.tounicode(patched), right)
+        return result
+
+    def test_same(self):
+        left = make_doc(['<record id="%s">%s</record>' % (i, i) for i in range(5)])
+        self.assertEqual(self._diff(left, left), [])
+
+    def test_update(self):
+        left = make_doc(
+            [
+                '<record id="1"><name>One</name></record>',
+                '<record id="2"><name>Two</name></record>',
+            ]
+        )
+        right = make_doc(
+            [
+                '<record id="1"><name>One</name></record>',
+                '<record id="2"><name>Deux</name><note/></record>',
+            ]
+        )
+        self.assertEqual(
+            self._diff(left, right),
+            [
+                actions.UpdateTextIn("/export/record[2]/name[1]", "Deux", "Two"),
+                actions.InsertNode("/export/record[2]", "note", 1),
+            ],
+        )
+
+    def test_insert_delete(self):
+        left = make_doc(['<record id="%s"/>' % i for i in (1, 2, 3)])
+        right = make_doc(['<record id="%s"/>' % i for i in (1, 4, 3)])
+        self.assertEqual(
+            self._diff(left, right),
+            [
+                actions.InsertNode("/export[1]", "record", 1),
+                actions.InsertAttrib("/export/record[2]", "id", "4"),
+                actions.DeleteNode("/export/record[3]"),
+            ],
+        )
+
+    def test_move(self):
+        left = make_doc(['<record id="%s"/>' % i for i in range(10)])
+
+        # One record moved down is one move
+        right = make_doc(['<record id="%s"/>' % i for i in (1, 2, 3, 4, 0, 5)])
+        right = right.replace("</export>", "")
+        right += "".join('<record id="%s"/>' % i for i in range(6, 10))
+        right += "</export>"
+        self.assertEqual(
+            self._diff(left, right),
+            [actions.MoveNode("/export/record[1]", "/export[1]", 4)],
+        )
+
+        # And so is one record moved up
+        right = make_doc(
+            ['<record id="%s"/>' % i for i in (7, 0, 1, 2, 3, 4, 5, 6, 8, 9)]
+        )
+        self.assertEqual(
+            self._diff(left, right),
+            [actions.MoveNode("/export/record[8]", "/export[1]", 0)],
+        )
+
+        # Unless it's moved further than the window
+        result = self._diff(left, right, window=3)
+        self.assertNotIn(actions.MoveNode, [type(action) for action in result])
+
+    def test_root(self):
+        left = '<export version="1"><record id="1">Text</record></export>'
+        right = '<data version="2">Header<record id="1">Text</record></data>'
+        self.assertEqual(
+            self._diff(left, right),
+            [
+                actions.RenameNode("/export[1]", "data"),
+                actions.UpdateAttrib("/data[1]", "version", "2"),
+                actions.UpdateTextIn("/data[1]", "Header", None),
+            ],
+        )
+
+    def test_root_diff_options(self):
+        # The roots are diffed with the same options as the records
+        left = '<export stamp="1"><record id="1" stamp="1">Text</record></export>'
+        right = '<export stamp="2"><record id="1" stamp="2">Text</record></export>'
+        differ = RecordDiffer("record", "id", diff_options={"ignored_attrs": ["stamp"]})
+        result = differ.diff(io.BytesIO(left.encode()), io.BytesIO(right.encode()))
+        self.assertEqual(list(result), [])
+
+    def test_namespaces(self):
+        left = (
+            '<x:export xmlns:x="urn:x" xmlns="urn:d">'
+            '<record id="1"><x:a>1</x:a></record><record id="2"/></x:export>'
+        )
+        right = (
+            '<x:export xmlns:x="urn:x" xmlns="urn:d">'
+            '<record id="2"/><record id="1"><x:a>2</x:a></record></x:export>'
+        )
+        differ = RecordDiffer("{urn:d}record", "id")
+        result = list(
+            differ.diff(io.BytesIO(left.encode()), io.BytesIO(right.encode()))
+        )
+        patched = patch.Patcher().patch(result, etree.fromstring(left))
+        self.assertEqual(etree.tounicode(patched), right)
+
+    def test_tails(self):
+        left = make_doc(['<record id="1"/>\n', '<record id="2"/>\n'])
+        right = make_doc(['<record id="2"/>\n', '<record id="1"/>changed'])
+        self.assertEqual(
+            self._diff(left, right, remove_blank_text=False),
+            [
+                actions.MoveNode("/export/record[2]", "/export[1]", 0),
+                actions.UpdateTextAfter("/export/record[2]", "changed", "\n"),
+            ],
+        )
+
+    def test_only_records(self):
+        for doc in (
+            '<export><record id="1"/><other/></export>',
+            '<export><record id="1"/><!-- Comment --></export>',
+        ):
+            with self.assertRaises(ValueError):
+                self._diff(doc, doc)
+
+        with self.assertRaises(ValueError):
+            RecordDiffer("record", "id", diff_options={"node_ids": True})
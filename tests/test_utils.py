@@ -1,3 +1,4 @@
+import random
 import unittest
 
 from lxml import etree
@@ -100,6 +101,25 @@ class TraverseTests(unittest.TestCase):
             ],
         )
 
+    def test_deep_tree(self):
+        # Deeper than the recursion limit
+        root = node = etree.Element("root")
+        for i in range(5000):
+            node = etree.SubElement(node, "node")
+
+        res = list(utils.post_order_traverse(root))
+        self.assertEqual(len(res), 5001)
+        self.assertIs(res[0], node)
+        self.assertIs(res[-1], root)
+
+        res = list(utils.reverse_post_order_traverse(root))
+        self.assertIs(res[0], node)
+        self.assertIs(res[-1], root)
+
+        res = list(utils.breadth_first_traverse(root))
+        self.assertIs(res[0], root)
+        self.assertIs(res[-1], node)
+
 
 class LongestCommonSubsequenceTests(unittest.TestCase):
     def _diff(self, left, right, result):
@@ -136,6 +156,129 @@ class LongestCommonSubsequenceTests(unittest.TestCase):
         # Empty sequences:
         self._diff("", "", "")
 
+    def test_lcs_long(self):
+        # Longer sequences with many changes, which need a long traceback
+        left = "The quick brown fox jumps over the lazy dog" * 5
+        right = "A quick brown cat jumped over two lazy dogs" * 5
+        lcs = list(utils.longest_common_subsequence(left, right))
+        for (x1, y1), (x2, y2) in zip(lcs, lcs[1:]):
+            self.assertLess(x1, x2)
+            self.assertLess(y1, y2)
+        for x, y in lcs:
+            self.assertEqual(left[x], right[y])
+
+        # It is the longest, compare with the classic dynamic programming
+        lengths = [[0] * (len(right) + 1) for x in range(len(left) + 1)]
+        for x, litem in enumerate(left):
+            for y, ritem in enumerate(right):
+                if litem == ritem:
+                    lengths[x + 1][y + 1] = lengths[x][y] + 1
+                else:
+                    lengths[x + 1][y + 1] = max(lengths[x][y + 1], lengths[x + 1][y])
+        self.assertEqual(len(lcs), lengths[-1][-1])
+
+    def test_lcs_max_cost(self):
+        left = "The quick brown fox jumps over the lazy dog"
+        right = "A quick brown cat jumped over two lazy dogs"
+        cutoffs = []
+        lcs = list(
+            utils.longest_common_subsequence(
+                left, right, max_cost=3, cutoff=lambda: cutoffs.append(1)
+            )
+        )
+        self.assertTrue(cutoffs)
+        # It's still a common subsequence, but perhaps not the longest
+        for (x1, y1), (x2, y2) in zip(lcs, lcs[1:]):
+            self.assertLess(x1, x2)
+            self.assertLess(y1, y2)
+        for x, y in lcs:
+            self.assertEqual(left[x], right[y])
+        longest = list(utils.longest_common_subsequence(left, right))
+        self.assertLessEqual(len(lcs), len(longest))
+
+        # With a high enough limit, it's never cut off
+        cutoffs = []
+        self.assertEqual(
+            list(
+                utils.longest_common_subsequence(
+                    left, right, max_cost=100, cutoff=lambda: cutoffs.append(1)
+                )
+            ),
+            longest,
+        )
+        self.assertFalse(cutoffs)
+
+    def test_lcs_eqfn(self):
+        # A comparison function gives the same result as ==
+        left = [1, 2, 3, 4, 5, 6, 7, 8]
+        right = [8, 2, 3, 9, 5, 1, 6, 7]
+        self.assertEqual(
+            list(utils.longest_common_subsequence(left, right)),
+            list(utils.longest_common_subsequence(left, right, lambda x, y: x == y)),
+        )
+
+    def test_longest_increasing_subsequence(self):
+        self.assertEqual(utils.longest_increasing_subsequence([]), [])
+        self.assertEqual(
+            utils.longest_increasing_subsequence([3, 1, 2, 5, 4, 6]), [1, 2, 4, 5]
+        )
+        # Strictly increasing
+        self.assertEqual(len(utils.longest_increasing_subsequence([2, 2, 2])), 1)
+
+        # For unique items it's as long as the longest common subsequence
+        rng = random.Random(42)
+        for i in range(20):
+            left = list(range(50))
+            right = rng.sample(left, 40)
+            positions = [left.index(item) for item in right]
+            lis = utils.longest_increasing_subsequence(positions)
+            lcs = utils.longest_common_subsequence(left, right)
+            self.assertEqual(len(lis), len(lcs))
+            self.assertEqual(
+                [positions[j] for j in lis], sorted(positions[j] for j in lis)
+            )
+
+
+class MinHashTests(unittest.TestCase):
+    def test_minhash(self):
+        text = "The quick brown fox jumps over the lazy dog"
+        signature = utils.minhash(text, 16)
+        self.assertEqual(len(signature), 16)
+        # It doesn't depend on the hash seed of the process
+        self.assertEqual(signature, utils.minhash(text, 16))
+
+        # Similar texts have similar signatures, different texts don't
+        similar = utils.minhash("The quick brown fox jumps over the lazy cat", 16)
+        different = utils.minhash("Lorem ipsum dolor sit amet", 16)
+        same = sum(a == b for a, b in zip(signature, similar))
+        self.assertGreater(same, sum(a == b for a, b in zip(signature, different)))
+
+        # Texts shorter than a shingle still get a signature
+        self.assertEqual(len(utils.minhash("a", 4)), 4)
+        self.assertEqual(len(utils.minhash("", 4)), 4)
+
+
+class FenwickTreeTests(unittest.TestCase):
+    def test_fenwick_tree(self):
+        tree = utils.FenwickTree(10)
+        for index in (2, 3, 7):
+            tree.add(index)
+
+        self.assertEqual(tree.prefix_sum(0), 0)
+        self.assertEqual(tree.prefix_sum(3), 1)
+        self.assertEqual(tree.prefix_sum(4), 2)
+        self.assertEqual(tree.prefix_sum(10), 3)
+
+        # The index of the first, second and third value
+        self.assertEqual(tree.find(1), 2)
+        self.assertEqual(tree.find(2), 3)
+        self.assertEqual(tree.find(3), 7)
+
+        tree.add(0, 2)
+        self.assertEqual(tree.prefix_sum(3), 3)
+        self.assertEqual(tree.find(2), 0)
+        self.assertEqual(tree.find(3), 2)
+
 
 class MakeAsciiTreeTests(unittest.TestCase):
     def test_make_ascii_tree(self):
@@ -1,8 +1,48 @@
+import heapq
+import time
+import warnings
+
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from copy import deepcopy
 from difflib import SequenceMatcher
 from lxml import etree
 from math import sqrt
 from xmldiff import utils, actions
+from xmldiff.snapshot import TreeSnapshot
+
+# How count_actions() counts the nodes that don't have a string tag
+_SPECIAL_TAGS = {etree.Comment: "#comment", etree.PI: "#pi"}
+
+# The Differ used by the worker processes to calculate leaf ratios.
+_worker_differ = None
+_worker_texts = None
+
+
+def _init_worker(ratio_mode, snapshot):
+    global _worker_differ, _worker_texts
+    _worker_differ = Differ(ratio_mode=ratio_mode)
+    _worker_texts = snapshot.texts
+
+
+def _leaf_ratios(block):
+    """Calculate the leaf ratios for a block of left node texts
+
+    The block is a list of (text, indexes) pairs, where the indexes are
+    the snapshot indexes of the candidate right nodes.
+    """
+    result = []
+    for text, indexes in block:
+        ratios = []
+        for i in indexes:
+            ratio = _worker_differ.text_ratio(text, _worker_texts[i])
+            ratios.append(ratio)
+            if ratio == 1.0:
+                # The match usually stops here. If it doesn't, the rest of
+                # the ratios are calculated by the main process.
+                break
+        result.append(ratios)
+    return result
 
 
 class Differ:
@@ -14,6 +54,18 @@ class Differ:
         fast_match=False,
         best_match=False,
         ignored_attrs=[],
+        hash_match=False,
+        tag_match=False,
+        tag_fallback=False,
+        gumtree_match=False,
+        workers=None,
+        lsh_bands=None,
+        lsh_rows=4,
+        timeout=None,
+        max_comparisons=None,
+        max_lcs_cost=None,
+        node_ids=False,
+        copy_left=True,
     ):
         # The minimum similarity between two nodes to consider them equal
         if F is None:
@@ -27,12 +79,45 @@ class Differ:
         self.uniqueattrs = uniqueattrs
         self.fast_match = fast_match
         self.best_match = best_match
+        # Match identical subtrees by their content hash before the
+        # similarity matching.
+        self.hash_match = hash_match
+        # Only compare nodes with the same tag, optionally falling back to
+        # nodes with other tags when no good enough match is found.
+        self.tag_match = tag_match
+        self.tag_fallback = tag_fallback
+        # A two pass top-down and bottom-up match, like GumTree does it.
+        self.gumtree_match = gumtree_match
+        # Calculate the leaf ratios in this many processes
+        self.workers = workers
+        # Find the candidates with locality sensitive hashing of the node
+        # texts, instead of comparing with all nodes.
+        self.lsh_bands = lsh_bands
+        self.lsh_rows = lsh_rows
+        # The budget for the matching, in seconds and node comparisons.
+        # When it runs out, the remaining nodes are only matched with nodes
+        # that have the same text.
+        self.timeout = timeout
+        self.max_comparisons = max_comparisons
+        # Limit the cost of the longest common subsequence searches. When
+        # it is exceeded, a good enough common subsequence is used instead.
+        self.max_lcs_cost = max_lcs_cost
+        # Refer to the nodes in the edit script by node ids instead of xpaths
+        self.node_ids = node_ids
+        # The diff modifies the left tree, so it's copied first, unless the
+        # caller doesn't need the left tree after the diff.
+        self.copy_left = copy_left
+        self.ratio_mode = ratio_mode
 
         # Avoid recreating this for every node
         self._sequencematcher = SequenceMatcher()
+        # The bounded mode gives the same result as accurate, but first
+        # checks the cheaper upper bounds, and skips the exact ratio if the
+        # nodes can't get a good enough match anyway.
+        self._bounded = ratio_mode == "bounded"
         if ratio_mode == "fast":
             self._sequence_ratio = self._sequencematcher.quick_ratio
-        elif ratio_mode == "accurate":
+        elif ratio_mode in ("accurate", "bounded"):
             self._sequence_ratio = self._sequencematcher.ratio
         elif ratio_mode == "faster":
             self._sequence_ratio = self._sequencematcher.real_quick_ratio
@@ -50,10 +135,29 @@ class Differ:
         self._matches = None
         self._l2rmap = None
         self._r2lmap = None
+        self._child_matches = None
         self._inorder = None
-        # Well, except the text cache, it's used by the ratio tests,
-        # so we set that to a dict so the tests work.
+        self._sibling_indexes = None
+        self._lsnap = None
+        self._rsnap = None
+        self._rcandidates = None
+        self._rbuckets = None
+        self._rorder = None
+        self._lsh_index = None
+        self._deadline = None
+        self._comparisons = 0
+        self._same_text_index = None
+        self._path_cache = None
+        self._path_versions = None
+        self._path_epoch = 0
+        self._new_node_ids = None
+        self._refer_to_nodes = False
+        self.budget_exceeded = False
+        self.lcs_cutoffs = 0
+        # Well, except the text and ratio caches, they are used by the
+        # ratio tests, so we set them to dicts so the tests work.
         self._text_cache = {}
+        self._leaf_ratios = {}
 
     def set_trees(self, left, right):
         self.clear()
@@ -68,7 +172,9 @@ class Differ:
             raise TypeError("The 'left' and 'right' parameters must be lxml Elements.")
 
         # Left gets modified as a part of the diff, deepcopy it first.
-        self.left = deepcopy(left)
+        if self.copy_left:
+            left = deepcopy(left)
+        self.left = left
         self.right = right
 
     def append_match(self, lnode, rnode, max_match):
@@ -76,6 +182,17 @@ class Differ:
         self._l2rmap[id(lnode)] = rnode
         self._r2lmap[id(rnode)] = lnode
 
+        # Count the matched children per pair of parents, for child_ratio()
+        lparent = lnode.getparent()
+        rparent = rnode.getparent()
+        if lparent is not None and rparent is not None:
+            key = (id(lparent), id(rparent))
+            if key in self._child_matches:
+                self._child_matches[key][0] += 1
+            else:
+                # Keep the parents, so that their ids stay valid
+                self._child_matches[key] = [1, lparent, rparent]
+
     def match(self, left=None, right=None):
         # This is not a generator, because the diff() functions needs
         # _l2rmap and _r2lmap, so if match() was a generator, then
@@ -98,12 +215,28 @@ class Differ:
         self._matches = []
         self._l2rmap = {}
         self._r2lmap = {}
+        self._child_matches = {}
         self._inorder = set()
+        self._sibling_indexes = {}
         self._text_cache = {}
+        self._leaf_ratios = {}
+        self._comparisons = 0
+        self._path_cache = {}
+        self._path_versions = {}
+        self._path_epoch = 0
+        self._new_node_ids = {}
+        self.budget_exceeded = False
+        self.lcs_cutoffs = 0
+        if self.timeout is not None:
+            self._deadline = time.monotonic() + self.timeout
+
+        # Take snapshots of the trees, unless identical() already did
+        if self._lsnap is None:
+            self.take_snapshots()
 
         # Generate the node lists
-        lnodes = list(utils.post_order_traverse(self.left))
-        rnodes = list(utils.post_order_traverse(self.right))
+        lnodes = list(self._lsnap.nodes)
+        rnodes = list(self._rsnap.nodes)
 
         # TODO: If the roots do not match, we should create new roots, and
         # have the old roots be children of the new roots, but let's skip
@@ -116,13 +249,33 @@ class Differ:
         lnodes.remove(self.left)
         rnodes.remove(self.right)
 
-        if self.fast_match:
+        if self.hash_match:
+            self.match_identical(lnodes, rnodes)
+            # Only the nodes that are left need the similarity matching
+            lnodes = [n for n in lnodes if id(n) not in self._l2rmap]
+            rnodes = [n for n in rnodes if id(n) not in self._r2lmap]
+
+        # Nodes with unique attributes can only match each other, so they
+        # are matched by looking them up, and never need to be compared.
+        # The matches are added in the loops below, to keep the order.
+        unique_matches = self.match_unique(lnodes, rnodes)
+
+        if self.gumtree_match:
+            self.match_gumtree(lnodes, unique_matches)
+            # Everything that can be matched is matched
+            lnodes = []
+
+        elif self.fast_match:
+
+            def is_match(lnode, rnode):
+                if id(lnode) in unique_matches or id(rnode) in unique_matches:
+                    return unique_matches.get(id(lnode)) is rnode
+                if self.over_budget():
+                    return self.same_text(lnode, rnode)
+                return self.match_ratio(lnode, rnode, self.F) >= self.F
+
             # First find matches with longest_common_subsequence:
-            matches = list(
-                utils.longest_common_subsequence(
-                    lnodes, rnodes, lambda x, y: self.node_ratio(x, y) >= self.F
-                )
-            )
+            matches = list(self.longest_common_subsequence(lnodes, rnodes, is_match))
 
             # Add the matches (I prefer this from start to finish):
             for left_match, right_match in matches:
@@ -133,19 +286,40 @@ class Differ:
                 lnodes.pop(left_match)
                 rnodes.pop(right_match)
 
-        elif self.best_match:
+        # The right nodes with unique attributes are never candidates
+        rnodes = [n for n in rnodes if id(n) not in unique_matches]
+
+        # Index the unmatched right nodes both in document order and by tag,
+        # so that matched nodes can be removed without scanning a list.
+        self._rcandidates = {id(rnode): rnode for rnode in rnodes}
+        self._rbuckets = {}
+        for rnode in rnodes:
+            self._rbuckets.setdefault(rnode.tag, {})[id(rnode)] = rnode
+        if self.lsh_bands:
+            self.index_lsh(rnodes)
+
+        if self.best_match and not self.fast_match:
             unmatched_lnodes = []
 
             # First find all nodes that match perfectly
-            for lnode in lnodes:
+            for lnode in self.prefetch_ratios(lnodes, unique_matches):
+                if id(lnode) in unique_matches:
+                    self.match_by_key(lnode, unique_matches[id(lnode)])
+                    continue
+
                 max_match = 0
                 match_node = None
 
-                for rnode in rnodes:
-                    match = self.node_ratio(lnode, rnode)
+                for rnode in self.candidates(lnode):
+                    if self.over_budget():
+                        # The main loop takes care of the rest
+                        unmatched_lnodes.append((lnode, match_node, max_match))
+                        break
+
+                    match = self.match_ratio(lnode, rnode, max(self.F, max_match))
                     if match == 1.0:
                         self.append_match(lnode, rnode, 1.0)
-                        rnodes.remove(rnode)
+                        self.remove_candidate(rnode)
                         break
 
                     if match > max_match:
@@ -157,44 +331,622 @@ class Differ:
 
             lnodes = []
             for lnode, rnode, max_match in unmatched_lnodes:
-                if max_match >= self.F and rnode in rnodes:
+                if max_match >= self.F and id(rnode) in self._rcandidates:
                     self.append_match(lnode, rnode, max_match)
                 else:
                     lnodes.append(lnode)
 
-        for lnode in lnodes:
-            max_match = 0
-            match_node = None
-
-            for rnode in rnodes:
-                match = self.node_ratio(lnode, rnode)
-                if match > max_match:
-                    match_node = rnode
-                    max_match = match
-
-                # Try to shortcut for nodes that are not only equal but also
-                # in the same place in the tree
-                if match == 1.0:
-                    # This is a total match, break here
-                    break
+        for lnode in self.prefetch_ratios(lnodes, unique_matches):
+            if id(lnode) in unique_matches:
+                self.match_by_key(lnode, unique_matches[id(lnode)])
+                continue
+
+            if self.over_budget():
+                self.match_same_text(lnode)
+                continue
+
+            match_node, max_match = self.find_best_match(lnode, self.candidates(lnode))
+
+            if max_match < self.F and self.tag_match and self.tag_fallback:
+                # Nothing good enough with the same tag, look for renames
+                others = (
+                    rnode
+                    for rnode in self._rcandidates.values()
+                    if rnode.tag != lnode.tag
+                )
+                other_node, other_match = self.find_best_match(lnode, others)
+                if other_match > max_match:
+                    match_node, max_match = other_node, other_match
 
             if max_match >= self.F:
                 self.append_match(lnode, match_node, max_match)
 
                 # We don't want to check nodes that already are matched
                 if match_node is not None:
-                    rnodes.remove(match_node)
+                    self.remove_candidate(match_node)
 
         # Match the roots
         self.append_match(self.left, self.right, 1.0)
         return self._matches
 
-    def node_ratio(self, left, right):
+    def unique_key(self, node):
+        """Return the first unique attribute of the node, and its value
+
+        Returns None if the node has none of the unique attributes.
+        """
+        if node.tag is etree.Comment:
+            return None
+
+        for index, attr in enumerate(self.uniqueattrs):
+            if not isinstance(attr, str):
+                # If it's actually a sequence of (tag, attr), the tag must
+                # match first.
+                tag, attr = attr
+                if tag != node.tag:
+                    continue
+            value = node.attrib.get(attr)
+            if value is not None:
+                return index, value
+        return None
+
+    def match_subtrees(self, lindex, rindex):
+        """Match two identical subtrees, given as snapshot indexes"""
+        lnodes = self._lsnap.nodes
+        rnodes = self._rsnap.nodes
+        for lsub, rsub in zip(self._lsnap.subtree(lindex), self._rsnap.subtree(rindex)):
+            self.append_match(lnodes[lsub], rnodes[rsub], 1.0)
+
+    def match_gumtree(self, lnodes, unique_matches):
+        """Match the trees in two passes, top-down and then bottom-up
+
+        This is a variation of the GumTree algorithm. The top-down pass
+        matches the biggest identical subtrees, and the bottom-up pass
+        matches the nodes whose children have been matched.
+        """
+        for lnode in lnodes:
+            if id(lnode) in unique_matches:
+                self.match_by_key(lnode, unique_matches[id(lnode)])
+
+        self.match_top_down()
+
+        for lnode in lnodes:
+            if id(lnode) in self._l2rmap or not len(lnode):
+                continue
+            # The candidates are the parents of the matches of the children
+            candidates = {}
+            for lchild in lnode:
+                rchild = self._l2rmap.get(id(lchild))
+                if rchild is None:
+                    continue
+                rparent = rchild.getparent()
+                if (
+                    rparent is not None
+                    and rparent is not self.right
+                    and id(rparent) not in self._r2lmap
+                ):
+                    candidates[id(rparent)] = rparent
+
+            match_node, max_match = self.find_best_match(lnode, candidates.values())
+            if max_match >= self.F:
+                self.append_match(lnode, match_node, max_match)
+                self.match_children(lnode, match_node)
+
+        # The roots are always matched, but we also want their children.
+        self.match_children(self.left, self.right)
+
+    def match_top_down(self):
+        lsnap = self._lsnap
+        rsnap = self._rsnap
+        lmatched = bytearray(len(lsnap))
+        rmatched = bytearray(len(rsnap))
+
+        # Nodes are taken from the heaps highest first. The counter keeps
+        # the nodes in document order for the same height.
+        counter = iter(range(len(lsnap) + len(rsnap)))
+        lheap = []
+        rheap = []
+
+        def push_children(heap, snap, index):
+            for child in snap.get_children(index):
+                heapq.heappush(heap, (-snap.heights[child], next(counter), child))
+
+        def pop_height(heap, height):
+            indexes = []
+            while heap and -heap[0][0] == height:
+                indexes.append(heapq.heappop(heap)[2])
+            return indexes
+
+        def match_subtrees(lindex, rindex):
+            for i in lsnap.subtree(lindex):
+                lmatched[i] = 1
+            for i in rsnap.subtree(rindex):
+                rmatched[i] = 1
+            self.match_subtrees(lindex, rindex)
+
+        # Nodes with unique attributes can already be matched
+        for i, node in enumerate(lsnap.nodes):
+            if id(node) in self._l2rmap:
+                lmatched[i] = 1
+        for i, node in enumerate(rsnap.nodes):
+            if id(node) in self._r2lmap:
+                rmatched[i] = 1
+
+        push_children(lheap, lsnap, len(lsnap) - 1)
+        push_children(rheap, rsnap, len(rsnap) - 1)
+        ambiguous = []
+
+        while lheap and rheap:
+            lheight = -lheap[0][0]
+            rheight = -rheap[0][0]
+            if lheight != rheight:
+                # Open the higher nodes, they can't be identical to anything
+                if lheight > rheight:
+                    for lindex in pop_height(lheap, lheight):
+                        push_children(lheap, lsnap, lindex)
+                else:
+                    for rindex in pop_height(rheap, rheight):
+                        push_children(rheap, rsnap, rindex)
+                continue
+
+            lgroups = {}
+            for lindex in pop_height(lheap, lheight):
+                lgroups.setdefault(lsnap.hashes[lindex], []).append(lindex)
+            rgroups = {}
+            for rindex in pop_height(rheap, rheight):
+                rgroups.setdefault(rsnap.hashes[rindex], []).append(rindex)
+
+            for hash, lgroup in lgroups.items():
+                rgroup = rgroups.pop(hash, None)
+                if rgroup is None:
+                    for lindex in lgroup:
+                        push_children(lheap, lsnap, lindex)
+                elif len(lgroup) == 1 and len(rgroup) == 1:
+                    lindex = lgroup[0]
+                    rindex = rgroup[0]
+                    if not lmatched[lindex] and not rmatched[rindex]:
+                        match_subtrees(lindex, rindex)
+                else:
+                    # More than one identical subtree, decide later
+                    ambiguous.append((lgroup, rgroup))
+            for rgroup in rgroups.values():
+                for rindex in rgroup:
+                    push_children(rheap, rsnap, rindex)
+
+        # Pair up the ambiguous subtrees, primarily those with matching
+        # parents, and then in document order.
+        for lgroup, rgroup in ambiguous:
+            rgroup = [i for i in rgroup if not rmatched[i]]
+            lgroup = [i for i in lgroup if not lmatched[i]]
+            for lindex in lgroup:
+                lparent = lsnap.nodes[lsnap.parents[lindex]]
+                rparent = self._l2rmap.get(id(lparent))
+                if rparent is None:
+                    continue
+                rparent = rsnap.index[id(rparent)]
+                for rindex in rgroup:
+                    if rsnap.parents[rindex] == rparent:
+                        match_subtrees(lindex, rindex)
+                        rgroup.remove(rindex)
+                        break
+            lgroup = [i for i in lgroup if not lmatched[i]]
+            for lindex, rindex in zip(lgroup, rgroup):
+                match_subtrees(lindex, rindex)
+
+    def match_children(self, lnode, rnode):
+        """Match the unmatched children of two matched nodes
+
+        Like the recovery of GumTree, the unmatched children are aligned
+        by their tags first, and the aligned children are matched if they
+        are similar enough. Only the children that are left after that are
+        compared with all the unmatched children with the same tag.
+        """
+        stack = [(lnode, rnode)]
+        while stack:
+            lnode, rnode = stack.pop()
+            rchildren = [c for c in rnode if id(c) not in self._r2lmap]
+            if not rchildren:
+                continue
+            lchildren = [c for c in lnode if id(c) not in self._l2rmap]
+
+            aligned = dict(
+                utils.longest_common_subsequence(
+                    [c.tag for c in lchildren], [c.tag for c in rchildren]
+                )
+            )
+            unmatched = {id(c): c for c in rchildren}
+            remaining = []
+            for x, lchild in enumerate(lchildren):
+                y = aligned.get(x)
+                if y is not None:
+                    rchild = rchildren[y]
+                    match = self.match_ratio(lchild, rchild, self.F)
+                    if match >= self.F:
+                        self.append_match(lchild, rchild, match)
+                        del unmatched[id(rchild)]
+                        stack.append((lchild, rchild))
+                        continue
+                remaining.append(lchild)
+
+            buckets = {}
+            for rchild in unmatched.values():
+                buckets.setdefault(rchild.tag, {})[id(rchild)] = rchild
+            for lchild in remaining:
+                candidates = buckets.get(lchild.tag)
+                if not candidates:
+                    continue
+                match_node, max_match = self.find_best_match(
+                    lchild, candidates.values()
+                )
+                if max_match >= self.F:
+                    self.append_match(lchild, match_node, max_match)
+                    del candidates[id(match_node)]
+                    stack.append((lchild, match_node))
+
+    def match_unique(self, lnodes, rnodes):
+        """Look up the matches of the nodes that have unique attributes
+
+        Returns a dict from the id() of every node with a unique attribute,
+        in both trees, to the node it matches, or None.
+        """
+        keyed_rnodes = {}
+        for rnode in rnodes:
+            key = self.unique_key(rnode)
+            if key is not None:
+                keyed_rnodes.setdefault(key, []).append(rnode)
+
+        unique_matches = {}
+        for bucket in keyed_rnodes.values():
+            for rnode in bucket:
+                unique_matches[id(rnode)] = None
+            # Reverse, so we can pop() the nodes in document order
+            bucket.reverse()
+
+        for lnode in lnodes:
+            key = self.unique_key(lnode)
+            if key is None:
+                continue
+
+            bucket = keyed_rnodes.get(key)
+            if bucket:
+                rnode = bucket.pop()
+                unique_matches[id(lnode)] = rnode
+                unique_matches[id(rnode)] = lnode
+            else:
+                unique_matches[id(lnode)] = None
+
+        return unique_matches
+
+    def match_by_key(self, lnode, rnode):
+        if rnode is not None and id(lnode) not in self._l2rmap:
+            self.append_match(lnode, rnode, 1.0)
+
+    def candidates(self, lnode):
+        """Return the unmatched right nodes that lnode can match"""
+        if self.tag_match:
+            candidates = self._rbuckets.get(lnode.tag, {})
+        else:
+            candidates = self._rcandidates
+        if self._lsh_index is None:
+            return candidates.values()
+
+        # The nodes that share a band of the signature, and the parents of
+        # the matches of the children, as they can match on the children.
+        found = set()
+        for band in self.lsh_signature(lnode):
+            found.update(self._lsh_index.get(band, ()))
+        for lchild in lnode:
+            rchild = self._l2rmap.get(id(lchild))
+            if rchild is not None:
+                found.add(id(rchild.getparent()))
+        found = [i for i in found if i in candidates]
+        # Keep the document order, so the result doesn't depend on hashes
+        found.sort(key=self._rorder.get)
+        return [candidates[i] for i in found]
+
+    def lsh_signature(self, node):
+        """Return the bands of the MinHash signature of the node text"""
+        if node.tag is etree.Comment:
+            text = node.text or ""
+        else:
+            text = self.node_text(node)
+        signature = utils.minhash(text, self.lsh_bands * self.lsh_rows)
+        rows = self.lsh_rows
+        # Comments and elements never match, so keep them in separate bands
+        return [
+            (index, node.tag is etree.Comment, signature[index : index + rows])
+            for index in range(0, len(signature), rows)
+        ]
+
+    def index_lsh(self, rnodes):
+        self._rorder = {}
+        self._lsh_index = {}
+        for index, rnode in enumerate(rnodes):
+            self._rorder[id(rnode)] = index
+            for band in self.lsh_signature(rnode):
+                self._lsh_index.setdefault(band, []).append(id(rnode))
+
+    def remove_candidate(self, rnode):
+        del self._rcandidates[id(rnode)]
+        del self._rbuckets[rnode.tag][id(rnode)]
+
+    def find_best_match(self, lnode, rnodes):
+        max_match = 0
+        match_node = None
+
+        for rnode in rnodes:
+            match = self.match_ratio(lnode, rnode, max(self.F, max_match))
+            if match > max_match:
+                match_node = rnode
+                max_match = match
+
+            # Try to shortcut for nodes that are not only equal but also
+            # in the same place in the tree
+            if match == 1.0:
+                # This is a total match, break here
+                break
+
+            if self.over_budget():
+                # Go with the best match so far
+                break
+
+        return match_node, max_match
+
+    def prefetch_ratios(self, lnodes, unique_matches, blocksize=32):
+        """Iterate over the left nodes, calculating leaf ratios ahead
+
+        With workers set, the leaf ratios of the coming left nodes and their
+        candidates are calculated in a process pool, while the matching
+        itself stays in this process, so the result is the same.
+        """
+        if not self.workers or self.workers < 2 or not self._rcandidates:
+            yield from lnodes
+            return
+
+        # The workers get the right snapshot, and the candidates by index
+        rsnap = self._rsnap
+        lsnap = self._lsnap
+
+        def submit(block):
+            tasks = []
+            for lnode in block:
+                if id(lnode) in unique_matches or lnode.tag is etree.Comment:
+                    tasks.append(None)
+                    continue
+                # Candidates are only removed, so these are all we need
+                indexes = [
+                    rsnap.index[id(rnode)]
+                    for rnode in self.candidates(lnode)
+                    if rnode.tag is not etree.Comment
+                ]
+                tasks.append((lsnap.texts[lsnap.index[id(lnode)]], indexes))
+            work = [task for task in tasks if task is not None]
+            return block, tasks, pool.submit(_leaf_ratios, work)
+
+        blocks = [
+            lnodes[start : start + blocksize]
+            for start in range(0, len(lnodes), blocksize)
+        ]
+        with ProcessPoolExecutor(
+            self.workers,
+            initializer=_init_worker,
+            initargs=(self.ratio_mode, rsnap),
+        ) as pool:
+            pending = [submit(block) for block in blocks[: self.workers * 2]]
+            next_block = len(pending)
+            while pending:
+                block, tasks, future = pending.pop(0)
+                if next_block < len(blocks):
+                    pending.append(submit(blocks[next_block]))
+                    next_block += 1
+
+                results = iter(future.result())
+                for lnode, task in zip(block, tasks):
+                    if task is not None:
+                        self._leaf_ratios[id(lnode)] = {
+                            id(rsnap.nodes[i]): ratio
+                            for i, ratio in zip(task[1], next(results))
+                        }
+                    yield lnode
+                    self._leaf_ratios.pop(id(lnode), None)
+
+    def snapshot(self, root, tag_ids=None, hash_keys=None):
+        """Take a TreeSnapshot of a tree, with this Differs node texts"""
+        return TreeSnapshot(root, self.node_text, self.node_attribs, tag_ids, hash_keys)
+
+    def take_snapshots(self):
+        # Take snapshots of the trees, with the same tag and hash tables
+        tag_ids = {}
+        hash_keys = {}
+        self._lsnap = self.snapshot(self.left, tag_ids, hash_keys)
+        self._rsnap = self.snapshot(self.right, tag_ids, hash_keys)
+
+    def identical(self, left=None, right=None):
+        """Check if the trees are identical, without matching them
+
+        The roots have the same hash only if the trees are identical, and
+        the namespaces, which the hashes don't include, are compared
+        separately. The snapshots are then reused by the match.
+        """
+        if left is not None or right is not None:
+            self.set_trees(left, right)
+        if self._lsnap is None:
+            self.take_snapshots()
+        return (
+            self._lsnap.hashes[-1] == self._rsnap.hashes[-1]
+            and self.left.nsmap == self.right.nsmap
+        )
+
+    def count_actions(self, left=None, right=None):
+        """Count the actions of the diff, without keeping an edit script
+
+        Returns a dict with the number of actions per action type, under
+        "actions", and per tag of the node they change, under "tags".
+        While counting, the actions refer to the nodes themselves, so no
+        xpaths are calculated.
+        """
+        stats = {"actions": {}, "tags": {}}
+        if self.identical(left, right):
+            return stats
+
+        types = stats["actions"]
+        tags = stats["tags"]
+        self._refer_to_nodes = True
+        try:
+            for action in self.diff():
+                name = type(action).__name__
+                types[name] = types.get(name, 0) + 1
+                if isinstance(action, actions.InsertNode):
+                    tag = action.tag
+                elif isinstance(action, actions.InsertComment):
+                    tag = etree.Comment
+                elif hasattr(action, "node"):
+                    # The diff hasn't changed the node yet
+                    tag = action.node.tag
+                else:
+                    # Namespaces
+                    continue
+                tag = _SPECIAL_TAGS.get(tag, tag)
+                tags[tag] = tags.get(tag, 0) + 1
+        finally:
+            self._refer_to_nodes = False
+        return stats
+
+    def clean_subtrees(self):
+        """Find the matched subtrees that need no updates
+
+        Returns a bytearray over the right snapshot, which is set for the
+        nodes whose subtree is identical to the subtree of its match, and
+        where all the nodes are matched with the corresponding node.
+        """
+        lsnap = self._lsnap
+        rsnap = self._rsnap
+        r2lmap = self._r2lmap
+        lindex = lsnap.index
+        clean = bytearray(len(rsnap))
+        # In post order, so the children are done before their parents
+        for ri, rnode in enumerate(rsnap.nodes):
+            lnode = r2lmap.get(id(rnode))
+            if lnode is None:
+                continue
+            li = lindex.get(id(lnode))
+            if li is None or lsnap.hashes[li] != rsnap.hashes[ri]:
+                continue
+            # The same hash means the same number of children
+            for lchild, rchild in zip(lsnap.get_children(li), rsnap.get_children(ri)):
+                if not clean[rchild] or (
+                    r2lmap[id(rsnap.nodes[rchild])] is not lsnap.nodes[lchild]
+                ):
+                    break
+            else:
+                clean[ri] = 1
+        return clean
+
+    def match_identical(self, lnodes, rnodes):
+        """Match identical subtrees, largest first"""
+        lsnap = self._lsnap
+        rsnap = self._rsnap
+
+        # Index the right subtrees by hash. Subtrees with the same hash
+        # have the same size, so they do not overlap, and post order is
+        # then also document order. Reverse it so we can pop() from the end.
+        candidates = {}
+        for rnode in reversed(rnodes):
+            rindex = rsnap.index[id(rnode)]
+            candidates.setdefault(rsnap.hashes[rindex], []).append(rindex)
+
+        # By matching the biggest subtrees first, a right subtree is either
+        # matched completely, or not at all, so checking the top node is
+        # enough. sorted() is stable, so same size nodes keep their order.
+        lindexes = [lsnap.index[id(lnode)] for lnode in lnodes]
+        for lindex in sorted(lindexes, key=lambda i: -lsnap.sizes[i]):
+            if id(lsnap.nodes[lindex]) in self._l2rmap:
+                # Matched as a part of a bigger subtree
+                continue
+
+            bucket = candidates.get(lsnap.hashes[lindex])
+            while bucket:
+                rindex = bucket.pop()
+                if id(rsnap.nodes[rindex]) in self._r2lmap:
+                    continue
+                self.match_subtrees(lindex, rindex)
+                break
+
+    def longest_common_subsequence(self, left, right, eqfn=utils.eq):
+        """The LCS, limited by max_lcs_cost, counting the cutoffs"""
+
+        def cutoff():
+            self.lcs_cutoffs += 1
+
+        return utils.longest_common_subsequence(
+            left, right, eqfn, max_cost=self.max_lcs_cost, cutoff=cutoff
+        )
+
+    def over_budget(self):
+        """Check if the timeout or the maximum comparisons are exceeded"""
+        if not self.budget_exceeded and (
+            (
+                self.max_comparisons is not None
+                and self._comparisons >= self.max_comparisons
+            )
+            or (self._deadline is not None and time.monotonic() > self._deadline)
+        ):
+            self.budget_exceeded = True
+            warnings.warn(
+                "The match budget was exceeded, the rest of the nodes are "
+                "only matched with nodes that have the same text.",
+                RuntimeWarning,
+            )
+        return self.budget_exceeded
+
+    def same_text(self, lnode, rnode):
+        """Check if the nodes have the same tag and texts in the snapshots"""
+        lindex = self._lsnap.index[id(lnode)]
+        rindex = self._rsnap.index[id(rnode)]
+        return (
+            self._lsnap.tags[lindex] == self._rsnap.tags[rindex]
+            and self._lsnap.texts[lindex] == self._rsnap.texts[rindex]
+        )
+
+    def match_same_text(self, lnode):
+        """Match the node with the first candidate with the same text
+
+        This is used when the budget has been exceeded, as it is only a
+        lookup, and never compares nodes.
+        """
+        if self._same_text_index is None:
+            # In reverse document order, so we can pop() from the end
+            self._same_text_index = {}
+            rsnap = self._rsnap
+            for rnode in reversed(list(self._rcandidates.values())):
+                rindex = rsnap.index[id(rnode)]
+                key = (rsnap.tags[rindex], rsnap.texts[rindex])
+                self._same_text_index.setdefault(key, []).append(rnode)
+
+        lindex = self._lsnap.index[id(lnode)]
+        key = (self._lsnap.tags[lindex], self._lsnap.texts[lindex])
+        bucket = self._same_text_index.get(key)
+        while bucket:
+            rnode = bucket.pop()
+            if id(rnode) in self._rcandidates:
+                self.append_match(lnode, rnode, 1.0)
+                self.remove_candidate(rnode)
+                return
+
+    def match_ratio(self, left, right, cutoff):
+        """The node_ratio(), with a cutoff if the ratio_mode is bounded"""
+        self._comparisons += 1
+        if self._bounded:
+            return self.node_ratio(left, right, cutoff)
+        return self.node_ratio(left, right)
+
+    def node_ratio(self, left, right, cutoff=0):
+        # With the bounded ratio_mode, a cutoff can be given. If the nodes
+        # can not reach that ratio, a value below the cutoff may be returned
+        # instead of the exact ratio.
         if left.tag is etree.Comment or right.tag is etree.Comment:
             if left.tag is etree.Comment and right.tag is etree.Comment:
                 # comments
-                self._sequencematcher.set_seqs(left.text, right.text)
-                return self._sequence_ratio()
+                return self.text_ratio(left.text, right.text, cutoff)
             # One is a comment the other is not:
             return 0
 
@@ -210,8 +962,15 @@ class Differ:
                 # If only one node has it, it means they are not the same.
                 return int(left.attrib.get(attr) == right.attrib.get(attr))
 
-        match = self.leaf_ratio(left, right)
         child_ratio = self.child_ratio(left, right)
+        if cutoff and child_ratio is not None:
+            # The leaf ratio needed to reach the cutoff, with some leeway
+            # for rounding errors.
+            cutoff = sqrt(max(0, 2 * cutoff**2 - child_ratio**2)) - 1e-9
+        if cutoff:
+            match = self.leaf_ratio(left, right, cutoff)
+        else:
+            match = self.leaf_ratio(left, right)
 
         if child_ratio is not None:
             match = sqrt((match**2 + child_ratio**2) / 2)
@@ -244,41 +1003,152 @@ class Differ:
             attribs.pop(key, None)
         return attribs
 
-    def leaf_ratio(self, left, right):
+    def leaf_ratio(self, left, right, cutoff=0):
         # How similar two nodes are, with no consideration of their children
         # We use a simple ratio here, I tried Levenshtein distances
         # but that took a 100 times longer.
+        ratios = self._leaf_ratios.get(id(left))
+        if ratios is not None and id(right) in ratios:
+            # Calculated by a worker process
+            return ratios[id(right)]
         ltext = self.node_text(left)
         rtext = self.node_text(right)
-        self._sequencematcher.set_seqs(ltext, rtext)
+        return self.text_ratio(ltext, rtext, cutoff)
+
+    def text_ratio(self, ltext, rtext, cutoff=0):
+        if self._bounded and cutoff > 0:
+            # Try the cheap upper bounds first. The first is the same as
+            # real_quick_ratio(), but doesn't need set_seqs().
+            length = len(ltext) + len(rtext)
+            if length:
+                bound = 2.0 * min(len(ltext), len(rtext)) / length
+                if bound < cutoff:
+                    return bound
+            self._sequencematcher.set_seqs(ltext, rtext)
+            bound = self._sequencematcher.quick_ratio()
+            if bound < cutoff:
+                return bound
+        else:
+            self._sequencematcher.set_seqs(ltext, rtext)
         return self._sequence_ratio()
 
     def child_ratio(self, left, right):
         # How similar the children of two nodes are
-        left_children = left.getchildren()
-        right_children = right.getchildren()
-        if not left_children and not right_children:
+        child_count = max(len(left), len(right))
+        if not child_count:
             return None
 
-        count = 0
-        child_count = max((len(left_children), len(right_children)))
-        for lchild in left_children:
-            for rchild in right_children:
-                if self._l2rmap.get(id(lchild)) is rchild:
-                    count += 1
-                    right_children.remove(rchild)
-                    break
-
+        matches = self._child_matches.get((id(left), id(right)))
+        count = matches[0] if matches else 0
         return count / child_count
 
+    def node_ref(self, node):
+        """Return how the edit script refers to a node in the left tree
+
+        That's the xpath, or with node_ids, the index of the node in the
+        post order of the original left tree. Inserted nodes get the
+        following numbers, in the order they are inserted.
+        """
+        if self._refer_to_nodes:
+            # count_actions() only needs the node
+            return node
+        if not self.node_ids:
+            return self.getpath(node)
+        ref = self._lsnap.index.get(id(node))
+        if ref is None:
+            ref = self._new_node_ids[id(node)]
+        return ref
+
+    def getpath(self, node):
+        """Return the xpath of a node in the left tree, like utils.getpath()"""
+        xpath = self.tree_path(node)
+        if xpath[-1] != "]":
+            xpath = xpath + "[1]"
+        return xpath
+
+    def tree_path(self, node):
+        """Return the getpath() of a node in the left tree, from a cache
+
+        A path only changes when the node or one of its ancestors is moved,
+        or when a sibling with the same tag is inserted, removed or renamed,
+        which is tracked by invalidate_path().
+        """
+        # Find the ancestors that haven't been checked since something
+        # changed, without recursion, as the tree can be very deep.
+        chain = []
+        parent_path = None
+        while node is not None:
+            entry = self._path_cache.get(id(node))
+            if entry is not None and entry[0] == self._path_epoch:
+                # Nothing has changed since this was checked
+                parent_path = entry[1]
+                break
+            chain.append(node)
+            node = node.getparent()
+
+        # Then check them from the top down
+        for node in reversed(chain):
+            parent_path = self._check_path(node, parent_path)
+        return parent_path
+
+    def _check_path(self, node, parent_path):
+        # The path of a node, when the path of its parent is parent_path
+        entry = self._path_cache.get(id(node))
+        parent = node.getparent()
+        if entry is not None:
+            _, path, _, cparent, group, version, cparent_path = entry
+            if (
+                parent is cparent
+                and self._path_group(node) == group
+                and self._path_versions.get((id(parent), group), 0) == version
+                and cparent_path == parent_path
+            ):
+                self._path_cache[id(node)] = (self._path_epoch,) + entry[1:]
+                return path
+
+        path = node.getroottree().getpath(node)
+        group = self._path_group(node)
+        version = self._path_versions.get((id(parent), group), 0)
+        # Keep the nodes in the cache, so the ids stay valid
+        self._path_cache[id(node)] = (
+            self._path_epoch,
+            path,
+            node,
+            parent,
+            group,
+            version,
+            parent_path,
+        )
+        return path
+
+    def _path_group(self, node):
+        # The siblings that are counted in the path of a node. Elements in
+        # a default namespace are "*[n]" in the path, and counted among all
+        # elements, the others among siblings with the same tag.
+        tag = node.tag
+        if isinstance(tag, str) and tag[0] == "{" and node.prefix is None:
+            return "*"
+        return tag
+
+    def invalidate_path(self, parent, tag):
+        """Invalidate the paths of the children of parent with the tag"""
+        keys = [(id(parent), tag)]
+        if isinstance(tag, str):
+            keys.append((id(parent), "*"))
+        for key in keys:
+            self._path_versions[key] = self._path_versions.get(key, 0) + 1
+        self._path_epoch += 1
+
     def update_node_tag(self, left, right):
         if left.tag != right.tag:
-            left_xpath = utils.getpath(left)
+            left_xpath = self.node_ref(left)
             yield actions.RenameNode(left_xpath, right.tag)
+            self.invalidate_path(left.getparent(), left.tag)
+            self.invalidate_path(left.getparent(), right.tag)
             left.tag = right.tag
 
     def update_node_attr(self, left, right):
-        left_xpath = utils.getpath(left)
+        left_xpath = self.node_ref(left)
 
         # Update: Look for differences in attributes
 
@@ -329,7 +1199,7 @@ class Differ:
             del left.attrib[key]
 
     def update_node_text(self, left, right):
-        left_xpath = utils.getpath(left)
+        left_xpath = self.node_ref(left)
 
         if left.text != right.text:
             yield actions.UpdateTextIn(left_xpath, right.text, left.text)
@@ -339,6 +1209,34 @@ class Differ:
             yield actions.UpdateTextAfter(left_xpath, right.tail, left.tail)
             left.tail = right.tail
 
+    def _sibling_index(self, parent):
+        # The children of a right side parent, their positions, and a
+        # Fenwick tree counting which of them are in order. The right tree
+        # doesn't change during the diff, so this is built once per parent.
+        entry = self._sibling_indexes.get(id(parent))
+        if entry is None:
+            children = parent.getchildren()
+            positions = {id(child): i for i, child in enumerate(children)}
+            inorder = utils.FenwickTree(len(children))
+            for i, child in enumerate(children):
+                if child in self._inorder:
+                    inorder.add(i)
+            # The parent is kept in the entry to keep its id() stable
+            entry = (parent, children, positions, inorder)
+            self._sibling_indexes[id(parent)] = entry
+        return entry
+
+    def mark_in_order(self, lnode, rnode):
+        self._inorder.add(lnode)
+        if rnode in self._inorder:
+            return
+        self._inorder.add(rnode)
+        rparent = rnode.getparent()
+        if rparent is not None:
+            entry = self._sibling_indexes.get(id(rparent))
+            if entry is not None:
+                entry[3].add(entry[2][id(rnode)])
+
     def find_pos(self, node):
         parent = node.getparent()
         # The paper here first checks if the child is the first child in
@@ -347,32 +1245,26 @@ class Differ:
         # deals with the case of no child being in order.
 
         # Find the last sibling before the child that is in order
-        i = parent.index(node)
-        while i >= 1:
-            i -= 1
-            sibling = parent[i]
-            if sibling in self._inorder:
-                # That's it
-                break
-        else:
+        _, children, positions, inorder = self._sibling_index(parent)
+        count = inorder.prefix_sum(positions[id(node)])
+        if not count:
             # No previous sibling in order.
             return 0
+        sibling = children[inorder.find(count)]
 
         # Now find the partner of this in the left tree
         sibling_match = self._r2lmap[id(sibling)]
         node_match = self._r2lmap.get(id(node))
 
-        i = 0
-        for child in sibling_match.getparent().getchildren():
-            if child is node_match:
-                # Don't count the node we're looking for.
-                continue
-            if child in self._inorder or child not in self._l2rmap:
-                # Count nodes that are in order, or will be deleted:
-                i += 1
-            if child is sibling_match:
-                # We found the position!
-                break
+        # The position is after the partner, but not counting the node
+        # we're looking for if it is before it. Historically this counted
+        # the children that are in order or will be deleted, but in effect
+        # it counted all of them, and that is kept for identical results.
+        lparent = sibling_match.getparent()
+        i = lparent.index(sibling_match) + 1
+        if node_match is not None and node_match.getparent() is lparent:
+            if lparent.index(node_match) < i:
+                i -= 1
         return i
 
     def align_children(self, left, right):
@@ -390,14 +1282,15 @@ class Differ:
             # Nothing to align
             return
 
-        lcs = utils.longest_common_subsequence(
-            lchildren, rchildren, lambda x, y: self._l2rmap[id(x)] is y
-        )
+        # Code the children as integers, the position of the left child,
+        # so the LCS can compare them with == instead of looking them up.
+        lpositions = {id(lchild): i for i, lchild in enumerate(lchildren)}
+        rcodes = [lpositions[id(self._r2lmap[id(rchild)])] for rchild in rchildren]
+        lcs = self.longest_common_subsequence(range(len(lchildren)), rcodes)
 
         for x, y in lcs:
             # Mark these as in order
-            self._inorder.add(lchildren[x])
-            self._inorder.add(rchildren[y])
+            self.mark_in_order(lchildren[x], rchildren[y])
 
         # Go over those children that are not in order:
         for lchild in lchildren:
@@ -410,14 +1303,15 @@ class Differ:
             rtarget = rchild.getparent()
             ltarget = self._r2lmap[id(rtarget)]
             yield actions.MoveNode(
-                utils.getpath(lchild), utils.getpath(ltarget), right_pos
+                self.node_ref(lchild), self.node_ref(ltarget), right_pos
             )
             # Do the actual move:
+            self.invalidate_path(left, lchild.tag)
+            self.invalidate_path(ltarget, lchild.tag)
             left.remove(lchild)
             ltarget.insert(right_pos, lchild)
             # Mark the nodes as in order
-            self._inorder.add(lchild)
-            self._inorder.add(rchild)
+            self.mark_in_order(lchild, rchild)
 
     def diff(self, left=None, right=None):
         # Make sure the matching is done first, diff() needs the l2r/r2l maps.
@@ -448,9 +1342,11 @@ class Differ:
         # The paper talks about the five phases, and then does four of them
         # in one phase, in a different order that described. This
         # implementation in turn differs in order yet again.
-        ltree = self.left.getroottree()
-
-        for rnode in utils.breadth_first_traverse(self.right):
+        clean = self.clean_subtrees()
+        # Go through the right tree breadth first
+        queue = deque([self.right])
+        while queue:
+            rnode = queue.popleft()
             # (a)
             rparent = rnode.getparent()
             ltarget = self._r2lmap.get(id(rparent))
@@ -461,21 +1357,21 @@ class Differ:
                 pos = self.find_pos(rnode)
                 # (ii)
                 if rnode.tag is etree.Comment:
-                    yield actions.InsertComment(
-                        utils.getpath(ltarget, ltree), pos, rnode.text
-                    )
+                    yield actions.InsertComment(self.node_ref(ltarget), pos, rnode.text)
                     lnode = etree.Comment(rnode.text)
                 else:
-                    yield actions.InsertNode(
-                        utils.getpath(ltarget, ltree), rnode.tag, pos
-                    )
+                    yield actions.InsertNode(self.node_ref(ltarget), rnode.tag, pos)
                     lnode = ltarget.makeelement(rnode.tag)
 
                     # (iii)
                 self.append_match(lnode, rnode, 1.0)
+                if self.node_ids:
+                    self._new_node_ids[id(lnode)] = len(self._lsnap) + len(
+                        self._new_node_ids
+                    )
+                self.invalidate_path(ltarget, lnode.tag)
                 ltarget.insert(pos, lnode)
-                self._inorder.add(lnode)
-                self._inorder.add(rnode)
+                self.mark_in_order(lnode, rnode)
                 # And then we update attributes. This is different from the
                 # paper, because the paper assumes nodes only has labels and
                 # values. Nodes also has texts, we do them later.
@@ -495,13 +1391,19 @@ class Differ:
                 if ltarget is not lparent:
                     pos = self.find_pos(rnode)
                     yield actions.MoveNode(
-                        utils.getpath(lnode, ltree), utils.getpath(ltarget, ltree), pos
+                        self.node_ref(lnode), self.node_ref(ltarget), pos
                     )
                     # Move the node from current parent to target
+                    self.invalidate_path(lparent, lnode.tag)
+                    self.invalidate_path(ltarget, lnode.tag)
                     lparent.remove(lnode)
                     ltarget.insert(pos, lnode)
-                    self._inorder.add(lnode)
-                    self._inorder.add(rnode)
+                    self.mark_in_order(lnode, rnode)
+
+                if clean[self._rsnap.index[id(rnode)]]:
+                    # The subtrees are identical and matched node for node,
+                    # so there is nothing to update or align inside them.
+                    continue
 
                 # Rename
                 yield from self.update_node_tag(lnode, rnode)
@@ -521,8 +1423,11 @@ class Differ:
             lnode = self._r2lmap[id(rnode)]
             yield from self.update_node_text(lnode, rnode)
 
+            queue.extend(rnode.getchildren())
+
         for lnode in utils.reverse_post_order_traverse(self.left):
             if id(lnode) not in self._l2rmap:
                 # No match
-                yield actions.DeleteNode(utils.getpath(lnode, ltree))
+                yield actions.DeleteNode(self.node_ref(lnode))
+                self.invalidate_path(lnode.getparent(), lnode.tag)
                 lnode.getparent().remove(lnode)
@@ -1,3 +1,5 @@
+import codecs
+import io
 import json
 import re
 
@@ -43,6 +45,11 @@ PLACEHOLDER_START = 0xE000
 
 
 class BaseFormatter:
+    # Set this to False if format() doesn't use the original tree while it
+    # goes through the diff. The diff can then be made by modifying that
+    # tree, instead of a copy of it.
+    uses_orig_tree = True
+
     def __init__(self, normalize=WS_TAGS, pretty_print=False):
         """Formatters must as a minimum have a normalize parameter
 
@@ -74,6 +81,37 @@ class BaseFormatter:
         but it may be ignored by differs that don't need it.
         """
 
+    def write(self, diff, orig_tree, output):
+        """Formats the diff and writes it to output, a text stream
+
+        Returns the number of actions in the diff. This formats the whole
+        diff first, formatters that can format one action at a time write
+        the actions as the diff generates them instead.
+        """
+        count = 0
+
+        def counted():
+            # The diff is still only generated as format() goes through it
+            nonlocal count
+            for action in diff:
+                count += 1
+                yield action
+
+        output.write(self.format(counted(), orig_tree))
+        return count
+
+
+class _DecodingWriter:
+    """Writes the encoded chunks lxml serializes to a text stream"""
+
+    def __init__(self, output, encoding):
+        self.output = output
+        # A character can be split between two chunks
+        self.decoder = codecs.getincrementaldecoder(encoding)()
+
+    def write(self, data):
+        self.output.write(self.decoder.decode(data))
+
 
 PlaceholderEntry = namedtuple("PlaceholderEntry", "element ttype close_ph")
 
@@ -204,32 +242,51 @@ class PlaceholderMaker:
         return result
 
     def undo_element(self, elem):
-        if self.placeholder2tag:
-            if elem.text:
-                index = 0
-                content = self.undo_string(elem.text)
-                if elem.text != content.text:
-                    # Placeholders was replaced
-                    elem.text = content.text
-                    for child in content:
-                        self.undo_element(child)
-                        elem.insert(index, child)
-                        index += 1
-
-            for child in elem:
-                self.undo_element(child)
-
-            if elem.tail:
-                content = self.undo_string(elem.tail)
-                if elem.tail != content.text:
-                    # Placeholders was replaced
-                    elem.tail = content.text
-                    parent = elem.getparent()
-                    index = parent.index(elem) + 1
-                    for child in content:
-                        self.undo_element(child)
-                        parent.insert(index, child)
-                        index += 1
+        if not self.placeholder2tag:
+            return
+
+        # This goes through the tree with a stack instead of recursion, as
+        # the tree can be very deep. The children are gone through after
+        # the text of their parent, and before its tail.
+        stack = [(elem, None)]
+        while stack:
+            elem, children = stack.pop()
+            if children is None:
+                self._undo_text(elem)
+                stack.append((elem, iter(elem)))
+                continue
+
+            for child in children:
+                stack.append((elem, children))
+                stack.append((child, None))
+                break
+            else:
+                self._undo_tail(elem)
+
+    def _undo_text(self, elem):
+        if elem.text:
+            index = 0
+            content = self.undo_string(elem.text)
+            if elem.text != content.text:
+                # Placeholders was replaced
+                elem.text = content.text
+                for child in content:
+                    self.undo_element(child)
+                    elem.insert(index, child)
+                    index += 1
+
+    def _undo_tail(self, elem):
+        if elem.tail:
+            content = self.undo_string(elem.tail)
+            if elem.tail != content.text:
+                # Placeholders was replaced
+                elem.tail = content.text
+                parent = elem.getparent()
+                index = parent.index(elem) + 1
+                for child in content:
+                    self.undo_element(child)
+                    parent.insert(index, child)
+                    index += 1
 
     def undo_tree(self, tree):
         self.undo_element(tree)
@@ -316,6 +373,9 @@ class XMLFormatter(BaseFormatter):
     as an attribute) should be used instead of one delete and one insert tag.
     """
 
+    # The original tree is copied before the diff starts
+    uses_orig_tree = False
+
     def __init__(
         self,
         normalize=WS_NONE,
@@ -352,8 +412,28 @@ class XMLFormatter(BaseFormatter):
         self.placeholderer.undo_tree(result_tree)
 
     def format(self, diff, orig_tree, differ=None):
+        """Formats the diff as the original tree with diff markup
+
+        The diff may be made by modifying orig_tree as the actions are
+        generated, so orig_tree must be copied before the first action is
+        pulled from the diff.
+        """
+        result, _ = self._mark_up(diff, orig_tree)
+        return self.render(result)
+
+    def write(self, diff, orig_tree, output):
+        result, count = self._mark_up(diff, orig_tree)
+        if type(self).render is not XMLFormatter.render:
+            # A subclass changes the rendering, and that makes a string
+            output.write(self.render(result))
+        else:
+            self.render_to(result, output)
+        return count
+
+    def _mark_up(self, diff, orig_tree):
         # Make a new tree, both because we want to add the diff namespace
-        # and also because we don't want to modify the original tree.
+        # and also because we don't want to modify the original tree. This
+        # must be done before the diff is started, see uses_orig_tree.
         result = deepcopy(orig_tree)
         if isinstance(result, etree._ElementTree):
             root = result.getroot()
@@ -363,17 +443,31 @@ class XMLFormatter(BaseFormatter):
         self._nsmap = [(DIFF_PREFIX, DIFF_NS)]
         etree.register_namespace(DIFF_PREFIX, DIFF_NS)
 
+        count = 0
         for action in diff:
             self.handle_action(action, root)
+            count += 1
 
         self.finalize(root)
 
         etree.cleanup_namespaces(result, top_nsmap=dict(self._nsmap))
-        return self.render(result)
+        return result, count
 
     def render(self, result):
         return etree.tounicode(result, pretty_print=self.pretty_print)
 
+    def render_to(self, result, output):
+        """Writes the same as render() returns to output, a stream
+
+        lxml serializes the tree in chunks of a few kilobytes, so no string
+        of the whole document is made. A binary stream gets UTF-8.
+        """
+        if not isinstance(result, etree._ElementTree):
+            result = etree.ElementTree(result)
+        if isinstance(output, io.TextIOBase):
+            output = _DecodingWriter(output, "utf-8")
+        result.write(output, encoding="utf-8", pretty_print=self.pretty_print)
+
     def handle_action(self, action, result):
         action_type = type(action)
         method = getattr(self, "_handle_" + action_type.__name__)
@@ -396,56 +490,60 @@ class XMLFormatter(BaseFormatter):
         # formatting a diff on the wrong tree, or against using ambiguous
         # edit script xpaths.
 
-        # First, make a namespace map that uses the left tree's URI's:
-        nsmap = dict(self._nsmap)
-        nsmap.update(node.nsmap)
+        while True:
+            # First, make a namespace map that uses the left tree's URI's:
+            nsmap = dict(self._nsmap)
+            nsmap.update(node.nsmap)
 
-        if xpath[0] == "/":
-            root = True
-            xpath = xpath[1:]
-        else:
-            root = False
+            if xpath[0] == "/":
+                root = True
+                xpath = xpath[1:]
+            else:
+                root = False
 
-        if "/" in xpath:
-            path, rest = xpath.split("/", 1)
-        else:
-            path = xpath
-            rest = ""
+            if "/" in xpath:
+                path, rest = xpath.split("/", 1)
+            else:
+                path = xpath
+                rest = ""
 
-        if "[" in path:
-            path, index = path[:-1].split("[")
-            index = int(index) - 1
-            multiple = False
-        else:
-            index = 0
-            multiple = True
-
-        if root:
-            path = "/" + path
-
-        matches = []
-        if None in nsmap:
-            del nsmap[None]
-        for match in node.xpath(path, namespaces=nsmap):
-            # Skip nodes that have been deleted
-            if DELETE_NAME not in match.attrib:
-                matches.append(match)
-        if index >= len(matches):
-            raise ValueError(
-                "xpath {}[{}] not found at {}.".format(
-                    path, index + 1, utils.getpath(node)
+            if "[" in path:
+                path, index = path[:-1].split("[")
+                index = int(index) - 1
+                multiple = False
+            else:
+                index = 0
+                multiple = True
+
+            if root:
+                path = "/" + path
+
+            matches = []
+            if None in nsmap:
+                del nsmap[None]
+            for match in node.xpath(path, namespaces=nsmap):
+                # Skip nodes that have been deleted
+                if DELETE_NAME not in match.attrib:
+                    matches.append(match)
+            if index >= len(matches):
+                raise ValueError(
+                    "xpath {}[{}] not found at {}.".format(
+                        path, index + 1, utils.getpath(node)
+                    )
                 )
-            )
-        if len(matches) > 1 and multiple:
-            raise ValueError(
-                "Multiple nodes found for xpath {} at {}.".format(
-                    path, utils.getpath(node)
+            if len(matches) > 1 and multiple:
+                raise ValueError(
+                    "Multiple nodes found for xpath {} at {}.".format(
+                        path, utils.getpath(node)
+                    )
                 )
-            )
-        match = matches[index]
-        if rest:
-            return self._xpath(match, rest)
-        return match
+            match = matches[index]
+            if not rest:
+                return match
+            # Continue with the rest of the path, in a loop and not by
+            # recursion, as the tree can be very deep.
+            node = match
+            xpath = rest
 
     def _extend_diff_attr(self, node, action, value):
         diffattr = f"{{{DIFF_NS}}}{action}-attr"
@@ -716,6 +814,9 @@ class XMLFormatter(BaseFormatter):
 
 
 class DiffFormatter(BaseFormatter):
+    # Only the actions are formatted
+    uses_orig_tree = False
+
     def __init__(self, normalize=WS_TAGS, pretty_print=False):
         self.normalize = normalize
         # No pretty print support, nothing to be pretty about
@@ -733,6 +834,15 @@ class DiffFormatter(BaseFormatter):
         res = "\n".join(self._format_action(action) for action in diff)
         return res
 
+    def write(self, diff, orig_tree, output):
+        count = 0
+        for action in diff:
+            if count:
+                output.write("\n")
+            output.write(self._format_action(action))
+            count += 1
+        return count
+
     def _format_action(
         self,
         action,
@@ -809,6 +919,9 @@ class DiffFormatter(BaseFormatter):
 class XmlDiffFormatter(BaseFormatter):
     """A formatter for an output trying to be xmldiff 0.6 compatible"""
 
+    # The xpaths of the actions are looked up in the original tree
+    uses_orig_tree = True
+
     def __init__(self, normalize=WS_TAGS, pretty_print=False):
         self.normalize = normalize
         # No pretty print support, nothing to be pretty about
@@ -829,6 +942,16 @@ class XmlDiffFormatter(BaseFormatter):
         res = "\n".join(self._format_action(action) for action in actions)
         return res
 
+    def write(self, diff, orig_tree, output):
+        count = 0
+        separator = ""
+        for action in diff:
+            for line in self.handle_action(action, orig_tree):
+                output.write(separator + self._format_action(line))
+                separator = "\n"
+            count += 1
+        return count
+
     def _format_action(self, action):
         return "[%s]" % ", ".join(action)
 
@@ -1,10 +1,19 @@
 """All major API points and command-line tools"""
 
+import contextlib
+import itertools
+import mmap
+import os
+import stat
+import sys
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
 from importlib import metadata
 
 from argparse import ArgumentParser, ArgumentTypeError
 from lxml import etree
-from xmldiff import diff, formatting, patch
+from xmldiff import diff, formatting, patch, stream
 
 __version__ = metadata.version("xmldiff")
 
@@ -15,45 +24,193 @@ FORMATTERS = {
 }
 
 
-def diff_trees(left, right, diff_options=None, formatter=None):
+def diff_trees(left, right, diff_options=None, formatter=None, mode=None, output=None):
     """Takes two lxml root elements or element trees"""
-    if formatter is not None:
-        formatter.prepare(left, right)
+    if mode not in (None, "first", "stats"):
+        raise ValueError("Unknown mode '%s'" % mode)
+    if output is not None and formatter is None:
+        raise ValueError("Writing to an output needs a formatter")
     if diff_options is None:
         diff_options = {}
     differ = diff.Differ(**diff_options)
-    diffs = differ.diff(left, right)
+
+    if mode == "stats":
+        # Only the numbers of actions, so the formatter isn't used
+        return differ.count_actions(left, right)
+
+    if formatter is not None:
+        formatter.prepare(left, right)
+    if mode == "first":
+        # Stop at the first difference, or don't diff at all
+        if differ.identical(left, right):
+            diffs = []
+        else:
+            diffs = list(itertools.islice(differ.diff(), 1))
+    else:
+        diffs = differ.diff(left, right)
 
     if formatter is None:
         return list(diffs)
 
+    if differ.node_ids:
+        # The formatters need the xpaths
+        diffs = patch.NodeIdResolver().resolve(diffs, left)
+    if output is not None:
+        # Written as the actions are found, and the number of them returned
+        return formatter.write(diffs, left, output)
     return formatter.format(diffs, left)
 
 
-def _diff(parse_method, left, right, diff_options=None, formatter=None):
+# The parsers of each thread, by their options
+_parsers = threading.local()
+
+
+def _get_parser(remove_blank_text, huge_tree):
+    # A parser must only be used by one thread at a time, but it can be
+    # reused, so each thread keeps one parser for each set of options.
+    parsers = getattr(_parsers, "parsers", None)
+    if parsers is None:
+        parsers = _parsers.parsers = {}
+    key = (remove_blank_text, huge_tree)
+    parser = parsers.get(key)
+    if parser is None:
+        parser = parsers[key] = etree.XMLParser(
+            remove_blank_text=remove_blank_text, huge_tree=huge_tree
+        )
+    return parser
+
+
+def _parse_mapped(source, parser):
+    """Parses a file from a memory map, instead of reading it in chunks"""
+    if isinstance(source, str):
+        with open(source, "rb") as f:
+            info = os.fstat(f.fileno())
+            # Pipes and empty files can't be mapped
+            if stat.S_ISREG(info.st_mode) and info.st_size:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+                    root = etree.fromstring(buffer, parser, base_url=source)
+                    return root.getroottree()
+    return etree.parse(source, parser)
+
+
+def _parse(parse_method, source, normalize, huge_tree):
+    return parse_method(source, _get_parser(normalize, huge_tree))
+
+
+def _diff(
+    parse_method,
+    left,
+    right,
+    diff_options=None,
+    formatter=None,
+    mode=None,
+    parallel=False,
+    huge_tree=False,
+    output=None,
+):
     normalize = bool(getattr(formatter, "normalize", 1) & formatting.WS_TAGS)
-    parser = etree.XMLParser(remove_blank_text=normalize)
-    left_tree = parse_method(left, parser)
-    right_tree = parse_method(right, parser)
+    if parallel:
+        # lxml releases the GIL while parsing, so the right document is
+        # parsed in a thread while the left one is parsed here. The left
+        # tree is the one the diff modifies, so it's made in this thread.
+        with ThreadPoolExecutor(1) as executor:
+            right_future = executor.submit(
+                _parse, parse_method, right, normalize, huge_tree
+            )
+            left_tree = _parse(parse_method, left, normalize, huge_tree)
+            right_tree = right_future.result()
+    else:
+        left_tree = _parse(parse_method, left, normalize, huge_tree)
+        right_tree = _parse(parse_method, right, normalize, huge_tree)
+    if mode == "stats" or not getattr(formatter, "uses_orig_tree", False):
+        # Nobody else uses the left tree, so it doesn't need to be copied
+        diff_options = {"copy_left": False, **(diff_options or {})}
     return diff_trees(
-        left_tree, right_tree, diff_options=diff_options, formatter=formatter
+        left_tree,
+        right_tree,
+        diff_options=diff_options,
+        formatter=formatter,
+        mode=mode,
+        output=output,
     )
 
 
-def diff_texts(left, right, diff_options=None, formatter=None):
-    """Takes two Unicode strings containing XML"""
+def diff_texts(
+    left,
+    right,
+    diff_options=None,
+    formatter=None,
+    mode=None,
+    parallel=False,
+    huge_tree=False,
+    output=None,
+):
+    """Takes two Unicode strings, bytes or buffers containing XML"""
     return _diff(
-        etree.fromstring, left, right, diff_options=diff_options, formatter=formatter
+        etree.fromstring,
+        left,
+        right,
+        diff_options=diff_options,
+        formatter=formatter,
+        mode=mode,
+        parallel=parallel,
+        huge_tree=huge_tree,
+        output=output,
     )
 
 
-def diff_files(left, right, diff_options=None, formatter=None):
+def diff_files(
+    left,
+    right,
+    diff_options=None,
+    formatter=None,
+    mode=None,
+    parallel=False,
+    huge_tree=False,
+    memory_map=False,
+    output=None,
+):
     """Takes two filenames or streams, and diffs the XML in those files"""
     return _diff(
-        etree.parse, left, right, diff_options=diff_options, formatter=formatter
+        _parse_mapped if memory_map else etree.parse,
+        left,
+        right,
+        diff_options=diff_options,
+        formatter=formatter,
+        mode=mode,
+        parallel=parallel,
+        huge_tree=huge_tree,
+        output=output,
     )
 
 
+def diff_records(
+    left,
+    right,
+    tag,
+    key,
+    diff_options=None,
+    window=10000,
+    remove_blank_text=True,
+    huge_tree=False,
+):
+    """Takes two filenames or streams, and diffs them record by record
+
+    The children of the roots are the records, with the tag, and they are
+    paired by the value of their key attribute. The files are streamed,
+    and the actions are generated as they are found.
+    """
+    differ = stream.RecordDiffer(
+        tag,
+        key,
+        window=window,
+        diff_options=diff_options,
+        remove_blank_text=remove_blank_text,
+        huge_tree=huge_tree,
+    )
+    return differ.diff(left, right)
+
+
 def validate_F(arg):
     """Type function for argparse - a float within some predefined bounds"""
     try:
@@ -83,11 +240,29 @@ def make_diff_parser():
         help="Display version and exit.",
         version="xmldiff %s" % __version__,
     )
+    parser.add_argument(
+        "-o",
+        "--output",
+        help="Write the diff to this file instead of to the standard output.",
+    )
     parser.add_argument(
         "--check",
         action="store_true",
         help="Return error code 1 if there are any differences between the files.",
     )
+    mode_group = parser.add_mutually_exclusive_group()
+    mode_group.add_argument(
+        "--first",
+        action="store_true",
+        help="Only show the first difference. Identical files are detected "
+        "quickly, but files that differ are still matched in full.",
+    )
+    mode_group.add_argument(
+        "--stats",
+        action="store_true",
+        help="Only show the number of actions per action type and per tag. "
+        "The whole diff is still made to count them.",
+    )
     parser.add_argument(
         "-f",
         "--formatter",
@@ -126,9 +301,39 @@ def make_diff_parser():
     parser.add_argument(
         "--ratio-mode",
         default="fast",
-        choices={"accurate", "fast", "faster"},
+        choices={"accurate", "bounded", "fast", "faster"},
         help="Choose the node comparison optimization.",
     )
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        help="Stop comparing nodes after this many seconds, and only match "
+        "the remaining nodes with nodes that have the same text.",
+    )
+    parser.add_argument(
+        "--max-comparisons",
+        type=int,
+        help="Stop comparing nodes after this many comparisons, and only "
+        "match the remaining nodes with nodes that have the same text.",
+    )
+    parser.add_argument(
+        "--max-lcs-cost",
+        type=int,
+        help="Limit the search for the longest common subsequence of nodes "
+        "to this many differences, and use a good enough one after that.",
+    )
+    parser.add_argument(
+        "--lsh-bands",
+        type=int,
+        help="Only compare nodes whose texts have similar MinHash signatures "
+        "in at least one of this many bands. More bands find more matches.",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        help="Compare the nodes in this many processes, "
+        "for large documents on machines with many cores.",
+    )
     match_group = parser.add_mutually_exclusive_group()
     match_group.add_argument(
         "--fast-match", action="store_true", help="A faster, less optimal match run."
@@ -138,6 +343,61 @@ def make_diff_parser():
         action="store_true",
         help="A slower, two-stage match run that may result in smaller diffs. (Experimental)",
     )
+    match_group.add_argument(
+        "--gumtree-match",
+        action="store_true",
+        help="A fast match run that first matches identical subtrees top-down, "
+        "and then their parents bottom-up.",
+    )
+    parser.add_argument(
+        "--hash-match",
+        action="store_true",
+        help="Match identical subtrees before comparing nodes, faster "
+        "for large documents with few changes.",
+    )
+    parser.add_argument(
+        "--tag-match",
+        action="store_true",
+        help="Only compare nodes that have the same tag.",
+    )
+    parser.add_argument(
+        "--tag-fallback",
+        action="store_true",
+        help="With --tag-match, compare with nodes with other tags if no "
+        "match is found, to detect renamed nodes.",
+    )
+    parser.add_argument(
+        "--parallel-parse",
+        action="store_true",
+        help="Parse the two files at the same time, in two threads.",
+    )
+    parser.add_argument(
+        "--memory-map",
+        action="store_true",
+        help="Parse the files from memory maps, instead of reading them.",
+    )
+    parser.add_argument(
+        "--huge-tree",
+        action="store_true",
+        help="Allow very deep trees and very long texts, like texts "
+        "over 10 MB, which otherwise stop the parsing.",
+    )
+    parser.add_argument(
+        "--record-tag",
+        help="Stream the files, and diff the children of the root, "
+        "which must all have this tag, one by one. Needs --record-key.",
+    )
+    parser.add_argument(
+        "--record-key",
+        help="With --record-tag, the attribute that pairs up the records.",
+    )
+    parser.add_argument(
+        "--record-window",
+        type=int,
+        default=10000,
+        help="With --record-tag, how many records away a moved record is "
+        "looked for. Records that moved further are deleted and inserted.",
+    )
     parser.add_argument(
         "--ignored-attributes",
         type=str,
@@ -163,6 +423,15 @@ def _parse_ignored_attrs(ignored_attrs):
     return [attr for attr in ignored_attrs.split(",")]
 
 
+def _format_stats(stats):
+    lines = []
+    for title, key in (("Actions", "actions"), ("Tags", "tags")):
+        lines.append("%s:" % title)
+        for name, count in sorted(stats[key].items()):
+            lines.append("  %s: %s" % (name, count))
+    return "\n".join(lines)
+
+
 def diff_command(args=None):
     parser = make_diff_parser()
     args = parser.parse_args(args=args)
@@ -182,16 +451,95 @@ def diff_command(args=None):
         "F": args.F,
         "fast_match": args.fast_match,
         "best_match": args.best_match,
+        "gumtree_match": args.gumtree_match,
+        "workers": args.workers,
+        "lsh_bands": args.lsh_bands,
+        "timeout": args.timeout,
+        "max_comparisons": args.max_comparisons,
+        "max_lcs_cost": args.max_lcs_cost,
+        "hash_match": args.hash_match,
+        "tag_match": args.tag_match,
+        "tag_fallback": args.tag_fallback,
         "uniqueattrs": _parse_uniqueattrs(args.unique_attributes),
     }
 
-    result = diff_files(
-        args.file1, args.file2, diff_options=diff_options, formatter=formatter
+    if args.record_tag or args.record_key:
+        if not (args.record_tag and args.record_key):
+            parser.error("--record-tag and --record-key must be used together")
+        if args.formatter != "diff" or args.stats:
+            parser.error("--record-tag only works with the diff formatter")
+
+    # Standard output is not closed afterwards
+    with (
+        open(args.output, "w", encoding="utf-8")
+        if args.output
+        else contextlib.nullcontext(sys.stdout)
+    ) as outfile:
+        if args.record_tag:
+            changes = _diff_records_command(args, formatter, diff_options, outfile)
+        else:
+            changes = _diff_files_command(args, formatter, diff_options, outfile)
+
+    if args.check and changes:
+        return 1
+
+
+def _diff_files_command(args, formatter, diff_options, output):
+    if args.first:
+        mode = "first"
+    elif args.stats:
+        mode = "stats"
+    else:
+        mode = None
+
+    if mode == "stats":
+        result = diff_files(
+            args.file1,
+            args.file2,
+            diff_options=diff_options,
+            mode=mode,
+            parallel=args.parallel_parse,
+            huge_tree=args.huge_tree,
+            memory_map=args.memory_map,
+        )
+        output.write(_format_stats(result) + "\n")
+        return sum(result["actions"].values())
+
+    # The diff is written as it's made
+    changes = diff_files(
+        args.file1,
+        args.file2,
+        diff_options=diff_options,
+        formatter=formatter,
+        mode=mode,
+        parallel=args.parallel_parse,
+        huge_tree=args.huge_tree,
+        memory_map=args.memory_map,
+        output=output,
     )
-    print(result)
+    output.write("\n")
+    return changes
+
+
+def _diff_records_command(args, formatter, diff_options, output):
+    actions = diff_records(
+        args.file1,
+        args.file2,
+        args.record_tag,
+        args.record_key,
+        diff_options=diff_options,
+        window=args.record_window,
+        remove_blank_text=bool(formatter.normalize & formatting.WS_TAGS),
+        huge_tree=args.huge_tree,
+    )
+    if args.first:
+        actions = itertools.islice(actions, 1)
 
-    if args.check and len(result) > 0:
-        return 1
+    # The actions are written as they are found
+    changes = formatter.write(actions, None, output)
+    if changes:
+        output.write("\n")
+    return changes
 
 
 def patch_tree(actions, tree):
@@ -204,7 +552,8 @@ def patch_text(actions, tree):
     """Takes a string with XML and a string with actions"""
     tree = etree.fromstring(tree)
     actions = patch.DiffParser().parse(actions)
-    tree = patch_tree(actions, tree)
+    # The tree is only used here, so it can be patched without a copy
+    tree = patch.Patcher().patch(actions, tree, copy=False)
     return etree.tounicode(tree)
 
 
@@ -221,7 +570,8 @@ def patch_file(actions, tree, diff_encoding=None):
         actions = actions.read()
 
     actions = patch.DiffParser().parse(actions)
-    tree = patch_tree(actions, tree)
+    # The tree is only used here, so it can be patched without a copy
+    tree = patch.Patcher().patch(actions, tree, copy=False)
     return etree.tounicode(tree)
 
 
@@ -3,7 +3,7 @@ import re
 from copy import deepcopy
 from json import loads
 from lxml import etree
-from xmldiff import actions
+from xmldiff import actions, utils
 
 
 DIFF_SPLIT = re.compile('(?:"[^"]*"|[^, ])+|(?<![^,])(?![^,])')
@@ -14,7 +14,16 @@ class Patcher:
     def nsmap(self):
         return getattr(self, "_nsmap", {})
 
-    def patch(self, actions, tree):
+    def patch(self, actions, tree, copy=True):
+        """Apply the actions to a copy of the tree, or to the tree itself"""
+        result = self._copy_tree(tree, copy)
+
+        for action in actions:
+            self.handle_action(action, result)
+
+        return result
+
+    def _copy_tree(self, tree, copy=True):
         if isinstance(tree, etree._ElementTree):
             tree = tree.getroot()
 
@@ -22,14 +31,30 @@ class Patcher:
         self._nsmap = tree.nsmap
         if None in self._nsmap:
             del self._nsmap[None]
+        self._nodes = None
 
         # Copy the tree so we don't modify the original
-        result = deepcopy(tree)
-
-        for action in actions:
-            self.handle_action(action, result)
-
-        return result
+        if copy:
+            tree = deepcopy(tree)
+        return tree
+
+    def get_node(self, ref, tree):
+        """Find a node from an xpath, or from a node id
+
+        The node ids are from a Differ with node_ids set, that is, the
+        index of the node in the post order of the original tree, and the
+        following numbers for inserted nodes.
+        """
+        if isinstance(ref, int):
+            if getattr(self, "_nodes", None) is None:
+                self._nodes = list(utils.post_order_traverse(tree))
+            return self._nodes[ref]
+        return tree.xpath(ref, namespaces=self.nsmap)[0]
+
+    def _inserted(self, action, node):
+        # Inserted nodes get the next node id
+        if isinstance(action.target, int) and self._nodes is not None:
+            self._nodes.append(node)
 
     def handle_action(self, action, tree):
         action_type = type(action)
@@ -37,54 +62,57 @@ class Patcher:
         method(action, tree)
 
     def _handle_DeleteNode(self, action, tree):
-        node = tree.xpath(action.node, namespaces=self.nsmap)[0]
+        node = self.get_node(action.node, tree)
         node.getparent().remove(node)
 
     def _handle_InsertNode(self, action, tree):
-        target = tree.xpath(action.target, namespaces=self.nsmap)[0]
+        target = self.get_node(action.target, tree)
         node = target.makeelement(action.tag)
         target.insert(action.position, node)
+        self._inserted(action, node)
 
     def _handle_RenameNode(self, action, tree):
-        tree.xpath(action.node, namespaces=self.nsmap)[0].tag = action.tag
+        self.get_node(action.node, tree).tag = action.tag
 
     def _handle_MoveNode(self, action, tree):
-        node = tree.xpath(action.node, namespaces=self.nsmap)[0]
+        node = self.get_node(action.node, tree)
         node.getparent().remove(node)
-        target = tree.xpath(action.target)[0]
+        target = self.get_node(action.target, tree)
         target.insert(action.position, node)
 
     def _handle_UpdateTextIn(self, action, tree):
-        tree.xpath(action.node, namespaces=self.nsmap)[0].text = action.text
+        self.get_node(action.node, tree).text = action.text
 
     def _handle_UpdateTextAfter(self, action, tree):
-        tree.xpath(action.node, namespaces=self.nsmap)[0].tail = action.text
+        self.get_node(action.node, tree).tail = action.text
 
     def _handle_UpdateAttrib(self, action, tree):
-        node = tree.xpath(action.node, namespaces=self.nsmap)[0]
+        node = self.get_node(action.node, tree)
         # This should not be used to insert new attributes.
         assert action.name in node.attrib
         node.attrib[action.name] = action.value
 
     def _handle_DeleteAttrib(self, action, tree):
-        del tree.xpath(action.node, namespaces=self.nsmap)[0].attrib[action.name]
+        del self.get_node(action.node, tree).attrib[action.name]
 
     def _handle_InsertAttrib(self, action, tree):
-        node = tree.xpath(action.node, namespaces=self.nsmap)[0]
+        node = self.get_node(action.node, tree)
         # This should not be used to update existing attributes.
         assert action.name not in node.attrib
         node.attrib[action.name] = action.value
 
     def _handle_RenameAttrib(self, action, tree):
-        node = tree.xpath(action.node, namespaces=self.nsmap)[0]
+        node = self.get_node(action.node, tree)
         assert action.oldname in node.attrib
         assert action.newname not in node.attrib
         node.attrib[action.newname] = node.attrib[action.oldname]
         del node.attrib[action.oldname]
 
     def _handle_InsertComment(self, action, tree):
-        target = tree.xpath(action.target)[0]
-        target.insert(action.position, etree.Comment(action.text))
+        target = self.get_node(action.target, tree)
+        node = etree.Comment(action.text)
+        target.insert(action.position, node)
+        self._inserted(action, node)
 
     def _handle_InsertNamespace(self, action, tree):
         self.nsmap[action.prefix] = action.uri
@@ -94,6 +122,31 @@ class Patcher:
         pass
 
 
+class NodeIdResolver(Patcher):
+    """Replaces the node ids in an edit script with xpaths
+
+    The actions are applied to a copy of the tree as they are resolved,
+    so each xpath is the path of the node at that point of the script.
+    """
+
+    def resolve(self, actions, tree):
+        result = self._copy_tree(tree)
+
+        for action in actions:
+            yield self.resolve_action(action, result)
+            self.handle_action(action, result)
+
+    def resolve_action(self, action, tree):
+        paths = {}
+        for field in ("node", "target"):
+            ref = getattr(action, field, None)
+            if isinstance(ref, int):
+                paths[field] = utils.getpath(self.get_node(ref, tree))
+        if paths:
+            return action._replace(**paths)
+        return action
+
+
 class DiffParser:
     """Makes a text diff into a list of actions"""
 
@@ -0,0 +1,91 @@
+from array import array
+from xmldiff import utils
+
+
+class TreeSnapshot:
+    """A snapshot of a tree as parallel arrays, indexed in post order
+
+    The descendants of the node at index i are the nodes from index
+    i - sizes[i] + 1 up to i, and its children are the indexes in
+    children[child_offsets[i] : child_offsets[i + 1]]. The root has the
+    parent -1.
+
+    Tag ids and subtree hashes are interned in the tag_ids and hash_keys
+    dicts. Give two snapshots the same dicts to make them comparable. Two
+    subtrees get the same hash only if they are identical.
+
+    The snapshot can be pickled, but the nodes themselves are then left out.
+    """
+
+    def __init__(self, root, node_text, node_attribs, tag_ids=None, hash_keys=None):
+        if tag_ids is None:
+            tag_ids = {}
+        if hash_keys is None:
+            hash_keys = {}
+
+        # The node list also keeps the lxml proxies alive, so the id()
+        # keys of the index are stable as long as the snapshot exists.
+        self.nodes = list(utils.post_order_traverse(root))
+        self.index = {id(node): i for i, node in enumerate(self.nodes)}
+
+        self.tags = array("l")
+        self.parents = array("l", [-1]) * len(self.nodes)
+        self.child_offsets = array("l", [0])
+        self.children = array("l")
+        self.sizes = array("l")
+        self.heights = array("l")
+        self.hashes = array("l")
+        self.texts = []
+        self.text_lengths = array("l")
+
+        index = self.index
+        sizes = self.sizes
+        heights = self.heights
+        hashes = self.hashes
+        for i, node in enumerate(self.nodes):
+            children = [index[id(child)] for child in node]
+            size = 1
+            height = 0
+            for child in children:
+                self.parents[child] = i
+                size += sizes[child]
+                height = max(height, heights[child])
+            self.children.extend(children)
+            self.child_offsets.append(len(self.children))
+            sizes.append(size)
+            heights.append(height + 1)
+
+            tag = node.tag
+            self.tags.append(tag_ids.setdefault(tag, len(tag_ids)))
+            if isinstance(tag, str):
+                text = node_text(node)
+            else:
+                # Comments and processing instructions
+                text = node.text or ""
+            self.texts.append(text)
+            self.text_lengths.append(len(text))
+
+            key = (
+                tag,
+                tuple(sorted(node_attribs(node).items())),
+                node.text,
+                node.tail,
+                tuple([hashes[child] for child in children]),
+            )
+            hashes.append(hash_keys.setdefault(key, len(hash_keys)))
+
+    def __len__(self):
+        return len(self.tags)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["nodes"]
+        del state["index"]
+        return state
+
+    def get_children(self, i):
+        return self.children[self.child_offsets[i] : self.child_offsets[i + 1]]
+
+    def subtree(self, i):
+        """The indexes of the subtree of the node at index i, in post order"""
+        return range(i - self.sizes[i] + 1, i + 1)
@@ -0,0 +1,261 @@
+"""Diffing documents with very many records, without parsing them fully"""
+
+import itertools
+
+from collections import OrderedDict
+from copy import deepcopy
+from lxml import etree
+from xmldiff import actions, diff, utils
+
+
+class _RecordDiffer(diff.Differ):
+    """A Differ for one record, with the xpaths of the whole document
+
+    parent_path is the path of the root of the document, and position is
+    the position of the record among the records, counting from 1.
+    """
+
+    parent_path = ""
+    position = 1
+
+    def getpath(self, node):
+        root_path = self.tree_path(self.left)
+        path = self.tree_path(node)
+        xpath = "%s%s[%s]%s" % (
+            self.parent_path,
+            root_path,
+            self.position,
+            path[len(root_path) :],
+        )
+        if xpath[-1] != "]":
+            xpath = xpath + "[1]"
+        return xpath
+
+
+class RecordDiffer:
+    """Diff two documents where the root has very many children, "records"
+
+    The documents are read with iterparse(), and the records are paired by
+    the value of their key attribute and diffed one pair at a time, so
+    only the records that are out of order are kept in memory. A record
+    is only looked for up to window records before or after its position,
+    and if it's further away it's deleted and inserted instead of moved.
+    The edit script is then still correct, only longer.
+
+    The children of the roots must all be records, with the record tag.
+    The actions are generated with xpaths in the whole left document, as
+    it is when the actions before them have been applied.
+    """
+
+    def __init__(
+        self,
+        tag,
+        key,
+        window=10000,
+        diff_options=None,
+        remove_blank_text=True,
+        huge_tree=False,
+    ):
+        self.tag = tag
+        self.key = key
+        self.window = window
+        if diff_options is None:
+            diff_options = {}
+        if diff_options.get("node_ids"):
+            raise ValueError("The record diff needs xpaths, not node ids")
+        # The left records are copies already
+        self.diff_options = {**diff_options, "copy_left": False}
+        self.remove_blank_text = remove_blank_text
+        self.huge_tree = huge_tree
+
+    def iterrecords(self, source):
+        """Parse a document, and generate its root and then its records
+
+        The root is a copy without children. A record is generated as a
+        copy when the next one starts, when its tail has been parsed, and
+        it's then removed from the tree, so the tree doesn't grow.
+        """
+        depth = 0
+        root = None
+        record = None
+        for event, element in etree.iterparse(
+            source,
+            events=("start", "end", "comment", "pi"),
+            remove_blank_text=self.remove_blank_text,
+            huge_tree=self.huge_tree,
+        ):
+            if event == "start":
+                depth += 1
+                if depth == 1:
+                    root = element
+                elif depth == 2:
+                    if record is None:
+                        # The first record, the text of the root is parsed
+                        yield self._copy_root(root)
+                    else:
+                        yield self._take_record(root, record)
+                    record = element
+            elif event == "end":
+                depth -= 1
+                if depth == 1 and element.tag != self.tag:
+                    raise ValueError(
+                        "All children of the root must be records, found %s"
+                        % element.tag
+                    )
+                if depth == 0:
+                    if record is None:
+                        yield self._copy_root(root)
+                    else:
+                        yield self._take_record(root, record)
+            elif depth == 1:
+                raise ValueError(
+                    "All children of the root must be records, found %s" % element
+                )
+
+    def _copy_root(self, root):
+        copy = etree.Element(root.tag, root.attrib, nsmap=root.nsmap)
+        copy.text = root.text
+        return copy
+
+    def _take_record(self, root, record):
+        # A copy keeps the tail, and the namespaces as they are declared,
+        # and then nothing of the record is left in the tree.
+        copy = deepcopy(record)
+        record.clear()
+        root.remove(record)
+        return copy
+
+    def diff(self, left, right):
+        """Generate the actions to turn the left document into the right
+
+        left and right are filenames or streams.
+        """
+        lrecords = self.iterrecords(left)
+        rrecords = self.iterrecords(right)
+
+        # First the roots, without their records
+        lroot = next(lrecords)
+        rroot = next(rrecords)
+        yield from diff.Differ(**self.diff_options).diff(lroot, rroot)
+        root_path = utils.getpath(rroot)
+        differ = _RecordDiffer(**self.diff_options)
+        differ.parent_path = rroot.getroottree().getpath(rroot)
+        # The xpath of the records, with the prefix getpath() uses
+        record = etree.SubElement(rroot, self.tag)
+        record_path = rroot.getroottree().getpath(record) + "[%s]"
+        rroot.remove(record)
+
+        # The left records that have been read, but not diffed yet, by key
+        # and in document order, with their position in the left document.
+        # In the left tree, as the actions are applied, the records that
+        # are done come first, in the order of the right document. Among
+        # them are the "parked" records, that were passed over, and after
+        # them come the "waiting" records, followed by the unread ones.
+        parked = OrderedDict()
+        waiting = OrderedDict()
+        read = 0
+        done = 0
+        while True:
+            batch = list(itertools.islice(rrecords, self.window))
+            if not batch:
+                break
+
+            # Left records that are too far behind are deleted. If they are
+            # further down in the right document, they are inserted there.
+            while parked:
+                lkey, (lindex, position, lrecord) = next(iter(parked.items()))
+                if lindex >= done - self.window:
+                    break
+                del parked[lkey]
+                yield actions.DeleteNode(record_path % (position + 1))
+            while waiting:
+                lkey, (lindex, lrecord) = next(iter(waiting.items()))
+                if lindex >= done - self.window:
+                    break
+                del waiting[lkey]
+                yield actions.DeleteNode(record_path % (done + len(parked) + 1))
+
+            # Read ahead, for the batch and the window after it
+            while read < done + len(batch) + self.window:
+                lrecord = next(lrecords, None)
+                if lrecord is None:
+                    break
+                lkey = lrecord.get(self.key)
+                if lkey is None or lkey in parked or lkey in waiting:
+                    # Records without a unique key are never matched
+                    lkey = object()
+                waiting[lkey] = (read, lrecord)
+                read += 1
+
+            # The records in the longest common subsequence are in order,
+            # and the waiting records before them are passed over. The keys
+            # are unique, so that's the longest increasing subsequence of
+            # the positions of the batch records among the waiting ones.
+            keys = list(waiting)
+            positions = {lkey: x for x, lkey in enumerate(keys)}
+            pairs = []
+            for i, rrecord in enumerate(batch):
+                x = positions.get(rrecord.get(self.key))
+                if x is not None:
+                    pairs.append((x, i))
+            in_order = {
+                pairs[j][1]: keys[pairs[j][0]]
+                for j in utils.longest_increasing_subsequence([x for x, i in pairs])
+            }
+
+            for i, rrecord in enumerate(batch):
+                key = rrecord.get(self.key)
+                lkey = in_order.get(i)
+                if lkey is not None and lkey in waiting:
+                    while True:
+                        passed, (lindex, lrecord) = waiting.popitem(last=False)
+                        if passed == lkey:
+                            break
+                        # The position doesn't count the parked records
+                        parked[passed] = (lindex, done, lrecord)
+                elif key in parked:
+                    for position, lkey in enumerate(parked):
+                        if lkey == key:
+                            break
+                    position += parked[key][1]
+                    yield actions.MoveNode(
+                        record_path % (position + 1),
+                        root_path,
+                        done + len(parked) - 1,
+                    )
+                    lrecord = parked.pop(key)[2]
+                elif key in waiting:
+                    for position, lkey in enumerate(waiting):
+                        if lkey == key:
+                            break
+                    position += done + len(parked)
+                    yield actions.MoveNode(
+                        record_path % (position + 1),
+                        root_path,
+                        done + len(parked),
+                    )
+                    lrecord = waiting.pop(key)[1]
+                else:
+                    yield actions.InsertNode(root_path, rrecord.tag, done + len(parked))
+                    lrecord = etree.Element(rrecord.tag, nsmap=rrecord.nsmap)
+
+                done += 1
+                if etree.tostring(lrecord) == etree.tostring(rrecord):
+                    # Most records usually haven't changed
+                    continue
+                differ.set_trees(lrecord, rrecord)
+                differ.position = done + len(parked)
+                for action in differ.diff():
+                    # The namespaces were handled with the roots
+                    if not isinstance(
+                        action, (actions.InsertNamespace, actions.DeleteNamespace)
+                    ):
+                        yield action
+
+        # The left records that are left over are deleted, the parked ones
+        # from the end, so the positions of the others don't change.
+        while parked:
+            lindex, position, lrecord = parked.popitem()[1]
+            yield actions.DeleteNode(record_path % (position + len(parked) + 1))
+        for lrecord in itertools.chain(waiting, lrecords):
+            yield actions.DeleteNode(record_path % (done + 1))
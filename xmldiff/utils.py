@@ -1,5 +1,9 @@
 import re
+import zlib
 
+from array import array
+from bisect import bisect_left
+from collections import deque
 from operator import eq
 
 # This namespace is reserved for lxml internal use, which only
@@ -8,98 +12,295 @@ RESERVED_NS = re.compile(r"ns\d+", flags=re.ASCII)
 
 
 def post_order_traverse(node):
-    for child in node.getchildren():
-        # PY3: Man, I want yield from!
-        yield from post_order_traverse(child)
-    yield node
+    # Iterative, so deep trees don't hit the recursion limit. The children
+    # of a node are listed when it is reached, like a recursive traversal.
+    stack = [(node, iter(node.getchildren()))]
+    while stack:
+        parent, children = stack[-1]
+        for child in children:
+            stack.append((child, iter(child.getchildren())))
+            break
+        else:
+            stack.pop()
+            yield parent
 
 
 def reverse_post_order_traverse(node):
-    for child in reversed(node.getchildren()):
-        # PY3: Man, I want yield from!
-        yield from reverse_post_order_traverse(child)
-    yield node
+    stack = [(node, reversed(node.getchildren()))]
+    while stack:
+        parent, children = stack[-1]
+        for child in children:
+            stack.append((child, reversed(child.getchildren())))
+            break
+        else:
+            stack.pop()
+            yield parent
 
 
 def breadth_first_traverse(node):
     # First yield the root node
-    queue = [node]
+    queue = deque([node])
 
     while queue:
-        item = queue.pop(0)
+        item = queue.popleft()
         yield item
         queue.extend(item.getchildren())
 
 
 # LCS from Myers: An O(ND) Difference Algorithm and Its Variations. This
-# implementation uses Chris Marchetti's technique of only keeping the history
-# per dpath, and not per node, so it should be vastly less memory intensive.
+# implementation keeps the furthest reaching x of each diagonal for each d,
+# and traces the path back from the end when it is found, so it only uses
+# O(D²) integers of memory, and no lists of matches are copied.
 # It also skips any items that are equal in the beginning and end, speeding
 # up the search, and using even less memory.
-def longest_common_subsequence(left_sequence, right_sequence, eqfn=eq):
+#
+# With the default eqfn the items are compared with == directly, without a
+# function call, so it is fastest to map the items to integers first.
+#
+# Like the heuristic in GNU diff, max_cost limits the search for very
+# different sequences: When the path isn't found after max_cost steps, the
+# path that has got the furthest is used up to where it got, and a new
+# search starts from there. The result is then still a common subsequence,
+# but perhaps not the longest. cutoff is called every time that happens.
+def longest_common_subsequence(
+    left_sequence, right_sequence, eqfn=eq, max_cost=None, cutoff=None
+):
     start = 0
     lend = lslen = len(left_sequence)
     rend = rslen = len(right_sequence)
+    fast = eqfn is eq
+
+    if fast:
+        while (
+            start < lend
+            and start < rend
+            and left_sequence[start] == right_sequence[start]
+        ):
+            start += 1
+        while (
+            start < lend
+            and start < rend
+            and left_sequence[lend - 1] == right_sequence[rend - 1]
+        ):
+            lend -= 1
+            rend -= 1
 
-    # Trim off the matching items at the beginning
-    while (
-        start < lend
-        and start < rend
-        and eqfn(left_sequence[start], right_sequence[start])
-    ):
-        start += 1
-
-    # trim off the matching items at the end
-    while (
-        start < lend
-        and start < rend
-        and eqfn(left_sequence[lend - 1], right_sequence[rend - 1])
-    ):
-        lend -= 1
-        rend -= 1
+    else:
+        # Trim off the matching items at the beginning
+        while (
+            start < lend
+            and start < rend
+            and eqfn(left_sequence[start], right_sequence[start])
+        ):
+            start += 1
+
+        # trim off the matching items at the end
+        while (
+            start < lend
+            and start < rend
+            and eqfn(left_sequence[lend - 1], right_sequence[rend - 1])
+        ):
+            lend -= 1
+            rend -= 1
 
     left = left_sequence[start:lend]
     right = right_sequence[start:rend]
 
     lmax = len(left)
     rmax = len(right)
-    furthest = {1: (0, [])}
 
     if not lmax + rmax:
         # The sequences are equal
         r = range(lslen)
         return zip(r, r)
 
+    history = []
+    x = y = 0
+    while True:
+        matches, end = _furthest_path(left, right, x, y, eqfn, max_cost)
+        history.extend(matches)
+        if end is None:
+            break
+        # The search was cut off, continue from where it got
+        if cutoff is not None:
+            cutoff()
+        x, y = end
+
+    return (
+        [(e, e) for e in range(start)]
+        + [(x + start, y + start) for x, y in history]
+        + list(zip(range(lend, lslen), range(rend, rslen)))
+    )
+
+
+def _furthest_path(left, right, lstart, rstart, eqfn, max_cost):
+    # Search for the path from (lstart, rstart) to the end. Returns the
+    # matches on the path, and None, or if the search is cut off, the
+    # matches up to the furthest point, and that point.
+    lmax = len(left)
+    rmax = len(right)
+    fast = eqfn is eq
+    size = lmax - lstart + rmax - rstart
+    if max_cost is not None:
+        size = min(size, max(max_cost, 1))
+
+    # The furthest x of each diagonal k is in furthest[offset + k], and
+    # trace[d] has the furthest x of the diagonals -d, -d + 2, ..., d.
+    # The diagonals are counted from the start, and y = x - k + ybase.
+    offset = size + 1
+    ybase = offset - lstart + rstart
+    furthest = [lstart] * (2 * offset + 1)
+    trace = []
+
     for d in range(0, lmax + rmax + 1):
-        for k in range(-d, d + 1, 2):
-            if k == -d or (k != d and furthest[k - 1][0] < furthest[k + 1][0]):
+        for k in range(offset - d, offset + d + 1, 2):
+            if k == offset - d or (
+                k != offset + d and furthest[k - 1] < furthest[k + 1]
+            ):
                 # Go down
-                old_x, history = furthest[k + 1]
-                x = old_x
+                x = furthest[k + 1]
             else:
                 # Go left
-                old_x, history = furthest[k - 1]
-                x = old_x + 1
+                x = furthest[k - 1] + 1
 
-            # Copy the history
-            history = history[:]
-            y = x - k
+            y = x - k + ybase
 
-            while x < lmax and y < rmax and eqfn(left[x], right[y]):
-                # We found a match
-                history.append((x + start, y + start))
-                x += 1
-                y += 1
+            if fast:
+                while x < lmax and y < rmax and left[x] == right[y]:
+                    # We found a match
+                    x += 1
+                    y += 1
+            else:
+                while x < lmax and y < rmax and eqfn(left[x], right[y]):
+                    x += 1
+                    y += 1
 
             if x >= lmax and y >= rmax:
                 # This is the best match
-                return (
-                    [(e, e) for e in range(start)]
-                    + history
-                    + list(zip(range(lend, lslen), range(rend, rslen)))
-                )
+                return _trace_back(trace, d, k - offset, x, lstart, rstart), None
+            else:
+                furthest[k] = x
+
+        trace.append(array("l", furthest[offset - d : offset + d + 1 : 2]))
+
+        if d and d == size and max_cost is not None:
+            # Too expensive, go with the diagonal that got the furthest
+            best = None
+            for k in range(offset - d, offset + d + 1, 2):
+                x = furthest[k]
+                y = x - k + ybase
+                if x <= lmax and y <= rmax and (best is None or x + y > best[0]):
+                    best = (x + y, k - offset, x, y)
+            if best is not None:
+                _, k, x, y = best
+                matches = _trace_back(trace, d, k, x, lstart, rstart)
+                return matches, (x, y)
+
+
+def _trace_back(trace, d, k, x, lstart, rstart):
+    # Follow the path that ends at x on diagonal k after d steps back to
+    # the start, and return the matches on the way in order.
+    history = []
+    ydiff = rstart - lstart
+    while True:
+        if d == 0:
+            snake_start = lstart
+        else:
+            previous = trace[d - 1]
+            # The index of diagonal k in previous is (k + d - 1) // 2
+            if k == -d or (
+                k != d and previous[(k + d - 2) // 2] < previous[(k + d) // 2]
+            ):
+                # We came down from diagonal k + 1
+                snake_start = previous[(k + d) // 2]
+                next_k = k + 1
+                next_x = snake_start
             else:
-                furthest[k] = (x, history)
+                # We came left from diagonal k - 1
+                next_x = previous[(k + d - 2) // 2]
+                snake_start = next_x + 1
+                next_k = k - 1
+
+        for match_x in range(x - 1, snake_start - 1, -1):
+            history.append((match_x, match_x - k + ydiff))
+
+        if d == 0:
+            history.reverse()
+            return history
+
+        d -= 1
+        k = next_k
+        x = next_x
+
+
+def longest_increasing_subsequence(sequence):
+    """The indexes of a longest strictly increasing subsequence
+
+    When the items of two sequences are unique, their longest common
+    subsequence is the longest increasing subsequence of the positions in
+    one sequence of the items of the other, and this finds it in
+    O(N log N) time, however different the sequences are.
+    """
+    # The smallest last item of an increasing subsequence of each length,
+    # and its index, and the index of the item before each item.
+    tails = []
+    tail_indexes = []
+    previous = array("l", [-1]) * len(sequence)
+    for i, item in enumerate(sequence):
+        length = bisect_left(tails, item)
+        if length:
+            previous[i] = tail_indexes[length - 1]
+        if length == len(tails):
+            tails.append(item)
+            tail_indexes.append(i)
+        else:
+            tails[length] = item
+            tail_indexes[length] = i
+
+    result = []
+    i = tail_indexes[-1] if tail_indexes else -1
+    while i != -1:
+        result.append(i)
+        i = previous[i]
+    result.reverse()
+    return result
+
+
+class FenwickTree:
+    """A binary indexed tree, for prefix sums of counts in logarithmic time"""
+
+    def __init__(self, size):
+        self._tree = [0] * (size + 1)
+        self._top = 1 << size.bit_length()
+
+    def add(self, index, value=1):
+        index += 1
+        while index < len(self._tree):
+            self._tree[index] += value
+            index += index & -index
+
+    def prefix_sum(self, end):
+        """The sum of the values before the index end"""
+        total = 0
+        while end > 0:
+            total += self._tree[end]
+            end -= end & -end
+        return total
+
+    def find(self, total):
+        """The first index where the sum of the values up to it reaches total
+
+        The values must not be negative.
+        """
+        index = 0
+        bit = self._top
+        while bit:
+            next_index = index + bit
+            if next_index < len(self._tree) and self._tree[next_index] < total:
+                index = next_index
+                total -= self._tree[next_index]
+            bit >>= 1
+        return index
 
 
 WHITESPACE = re.compile("\\s+", flags=re.MULTILINE)
@@ -109,6 +310,37 @@ def cleanup_whitespace(text):
     return WHITESPACE.sub(" ", text)
 
 
+# A Mersenne prime, and a hash function modulo it, for minhash()
+MINHASH_PRIME = (1 << 61) - 1
+MINHASH_A = 1103515245123456789 % MINHASH_PRIME
+MINHASH_B = 12345678910111213 % MINHASH_PRIME
+
+
+def minhash(text, count, size=3):
+    """Calculate a MinHash signature of the character shingles of a text
+
+    This uses one permutation hashing: every shingle is hashed only once,
+    and the hashes are divided into count bins, where each bin keeps its
+    smallest hash. Empty bins borrow the value of the next bin. The hashes
+    don't use the builtin hash(), so signatures are the same between runs.
+    """
+    bins = [None] * count
+    for i in range(max(1, len(text) - size + 1)):
+        shingle = zlib.crc32(text[i : i + size].encode("utf8"))
+        value, index = divmod((MINHASH_A * shingle + MINHASH_B) % MINHASH_PRIME, count)
+        if bins[index] is None or value < bins[index]:
+            bins[index] = value
+
+    for index in range(count):
+        if bins[index] is None:
+            offset = 1
+            while bins[(index + offset) % count] is None:
+                offset += 1
+            # Mark it as borrowed, so it doesn't match real values
+            bins[index] = (offset, bins[(index + offset) % count])
+    return tuple(bins)
+
+
 def getpath(element, tree=None):
     if tree is None:
         tree = element.getroottree()